@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Builds cached artifacts (transducers and other files) in dependency order,
+in parallel on a pool of processes.
+
+Every artifact is a file. An artifact that exists on disk is done, so an
+interrupted build resumes from the artifacts that were completed."""
+
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+
+def StableRepr(value):
+  """repr() that does not depend on the iteration order of sets and dicts."""
+  if isinstance(value, (set, frozenset)):
+    return "{" + ", ".join(sorted(StableRepr(v) for v in value)) + "}"
+  if isinstance(value, dict):
+    return "{" + ", ".join(sorted(StableRepr(k) + ": " + StableRepr(v)
+                                  for k, v in value.items())) + "}"
+  if isinstance(value, (list, tuple)):
+    return "[" + ", ".join(StableRepr(v) for v in value) + "]"
+  return repr(value)
+
+def Hash(value):
+  m = hashlib.md5()
+  m.update(StableRepr(value).encode("utf-8"))
+  return m.hexdigest()
+
+def SourceHash(module):
+  """Hash of the source file of a module, for the inputs of an artifact. It
+     is named by the file, so a script and its import (__main__ and its
+     module name) have the same key."""
+  m = hashlib.md5()
+  with open(module.__file__, "rb") as f:
+    m.update(f.read())
+  return (os.path.basename(module.__file__), m.hexdigest())
+
+class Artifact(object):
+  def __init__(self, name, filename, build, deps=()):
+    """build(filename) writes the artifact to filename. It may read the files
+       of the artifacts in deps, which are built before it."""
+    self.name = name
+    self.filename = filename
+    self.build = build
+    self.deps = list(deps)
+
+  def Filename(self):
+    return self.filename
+
+  def Done(self):
+    filename = self.Filename()
+    return filename is not None and os.path.isfile(filename)
+
+  def Build(self):
+    os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+    tmp_filename = "{}.tmp.{}".format(self.filename, os.getpid())
+    self.build(tmp_filename)
+    # Renaming is atomic, so a partially written artifact is never Done.
+    os.rename(tmp_filename, self.filename)
+
+class TrackedArtifact(Artifact):
+  """An artifact stored under a key of exactly what it was built from:
+
+  - inputs: builder sources and flags, known before building.
+  - the files of its deps.
+  - the values of the fields and weights that recorder saw being read while
+    building. Their names are saved in a manifest next to the artifact, so
+    the key is known without building it again.
+
+  recorder has StartRecording(), StopRecording() -> manifest and
+  RecordedValues(manifest)."""
+  def __init__(self, name, base_dir, build, recorder, deps=(), inputs=(), suffix=".tr"):
+    super(TrackedArtifact, self).__init__(name, None, build, deps)
+    self.base_dir = os.path.join(base_dir, name)
+    self.recorder = recorder
+    self.inputs = list(inputs)
+    self.suffix = suffix
+
+  def InputsKey(self):
+    return Hash([self.inputs, [dep.Filename() for dep in self.deps]])
+
+  def ManifestFilename(self):
+    return os.path.join(self.base_dir, self.InputsKey() + ".deps")
+
+  def Filename(self):
+    manifest_filename = self.ManifestFilename()
+    if not os.path.isfile(manifest_filename):
+      return None
+    with open(manifest_filename) as f:
+      manifest = json.load(f)
+    values_key = Hash(self.recorder.RecordedValues(manifest))
+    return os.path.join(self.base_dir, self.InputsKey(), values_key + self.suffix)
+
+  def Build(self):
+    os.makedirs(self.base_dir, exist_ok=True)
+    tmp_filename = os.path.join(self.base_dir, "{}.tmp.{}".format(self.name, os.getpid()))
+    self.recorder.StartRecording()
+    try:
+      self.build(tmp_filename)
+    finally:
+      manifest = self.recorder.StopRecording()
+    manifest_filename = self.ManifestFilename()
+    with open(manifest_filename + ".tmp.{}".format(os.getpid()), "w") as f:
+      json.dump(manifest, f, indent=1)
+    os.rename(manifest_filename + ".tmp.{}".format(os.getpid()), manifest_filename)
+    filename = self.Filename()
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    os.rename(tmp_filename, filename)
+
+# Artifacts of the current build. Worker processes are forked after they are
+# set, so the build functions (closures) do not have to be pickled.
+_artifacts = {}
+
+def _Build(name):
+  start_time = time.time()
+  _artifacts[name].Build()
+  return time.time() - start_time
+
+def BuildArtifacts(artifacts, num_jobs=1):
+  """Builds the artifacts that are not done yet, once all their dependencies
+     are. With num_jobs > 1 independent artifacts are built in parallel."""
+  global _artifacts
+  by_name = {a.name: a for a in artifacts}
+  pending = {a.name for a in artifacts if not a.Done()}
+  if not pending:
+    return
+  for name in pending:
+    for dep in by_name[name].deps:
+      assert by_name.get(dep.name) is dep, (name, dep.name)
+  print("Building {} of {} artifacts with {} jobs".format(len(pending), len(by_name), num_jobs))
+
+  def Ready(name):
+    return all(dep.name not in pending for dep in by_name[name].deps)
+
+  _artifacts = by_name
+  try:
+    if num_jobs <= 1:
+      while pending:
+        name = next(n for n in sorted(pending) if Ready(n))
+        print("  built {} in {:.1f} sec".format(name, _Build(name)))
+        pending.remove(name)
+      return
+
+    context = multiprocessing.get_context("fork")
+    with concurrent.futures.ProcessPoolExecutor(num_jobs, mp_context=context) as executor:
+      running = {}
+      while pending:
+        for name in sorted(pending):
+          if name not in running.values() and Ready(name):
+            running[executor.submit(_Build, name)] = name
+        assert running, ("Cyclic dependencies", pending)
+        done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+          name = running.pop(future)
+          print("  built {} in {:.1f} sec".format(name, future.result()))
+          pending.remove(name)
+  finally:
+    _artifacts = {}
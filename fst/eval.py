@@ -8,12 +8,14 @@ import os
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--test_file_name')
-parser.add_argument('--test_out_dir', required=True)
+parser.add_argument('--test_out_dir')
 parser.add_argument('--reachability_dir')
+parser.add_argument('--test_lines_file',
+                    help='File with the numbers of the lines of the test file to use, one per line.')
 parser.add_argument('--accuracy_at_n', default=1, type=int)
 parser.add_argument('--max_weight', default=1000000000000.0, type=float)
 parser.add_argument('--ar_pronunciation_dict', default="../data/pron-dict/pron-dict.loan.ar")
-args = parser.parse_args()
+args = None  # Set in main.
 
 def LoadPronDict(filename):
   result = collections.defaultdict(set)
@@ -32,8 +34,15 @@ def ReadWordsToSet(filename):
     result.add("".join(line.strip().split()))
   return result
 
-def ReadInput(ar_pron_dict, test_file_name, test_out_getter, reachability_dir):
+def ReadLineNumbers(filename):
+  if not filename:
+    return None
+  return set(int(line) for line in open(filename) if line.strip())
+
+def ReadInput(ar_pron_dict, test_file_name, test_out_getter, reachability_dir, test_lines=None):
   for i, line in enumerate(open(test_file_name)):
+    if test_lines is not None and i not in test_lines:
+      continue
     tokens = line.strip().split(" ||| ")
     en, sw, ar_buck = tokens[:3]
     correct_ar_words = set()
@@ -44,9 +53,17 @@ def ReadInput(ar_pron_dict, test_file_name, test_out_getter, reachability_dir):
       print("Line {} SW word {}".format(i, sw_w))
       sample_filename = "{}_{}".format(i, sw_w)
       reachability_filename = os.path.join(reachability_dir, sample_filename)
-      if not os.path.isfile(reachability_filename):
+      if os.path.isfile(reachability_filename):
+        reachable_ar_words = ReadWordsToSet(reachability_filename)
+      elif os.path.isfile(reachability_filename + ".correct_reachable"):
+        # Written by loanwords.py --prune_at_best_correct, which only knows
+        # whether the correct words are reachable.
+        if open(reachability_filename + ".correct_reachable").read().strip() == "True":
+          reachable_ar_words = correct_ar_words
+        else:
+          reachable_ar_words = set()
+      else:
         continue
-      reachable_ar_words = ReadWordsToSet(reachability_filename)
       test_result = TestResult(en, i, sw_w, correct_ar_words, reachable_ar_words)
       test_output = test_out_getter.GetTestResults(sample_filename)
       if test_output is None:
@@ -59,7 +76,12 @@ class TestOutGetterFromDir(object):
     self.test_out_dir = test_out_dir
 
   def GetTestResults(self, filename):
-    line = open(os.path.join(self.test_out_dir, filename)).readlines()[0]
+    # Samples skipped by loanwords.py (e.g. with --skip_unreachable_correct)
+    # have no output.
+    test_out_filename = os.path.join(self.test_out_dir, filename)
+    if not os.path.isfile(test_out_filename):
+      return None
+    line = open(test_out_filename).readlines()[0]
     return self.ConvertLineToTestResult(line)
 
   def ConvertLineToTestResult(self, line):
@@ -113,45 +135,66 @@ class TestResult(object):
         correct_results_at_n += 1
     return results_at_n, correct_results_at_n
 
-def main():
-  print("Loading pronunciation dicts")
-  ar_pron_dict = LoadPronDict(args.ar_pronunciation_dict)
-  test_out_getter = TestOutGetterFromDir(args.test_out_dir)
-
-  input_iter = ReadInput(ar_pron_dict, args.test_file_name,
-                         test_out_getter, args.reachability_dir)
-  num_of_reachable_samples = 0
-  num_of_reachable_correct_samples = 0
-  num_of_unreachable_samples = 0
-  sum_reachable_correct_hard_accuracy = 0.0
-  sum_reachable_correct_soft_accuracy = 0.0
-  sum_hard_accuracy = 0.0
-  sum_soft_accuracy = 0.0
+def Evaluate(ar_pron_dict, test_file_name, test_out_dir, reachability_dir,
+             accuracy_at_n=1, max_weight=parser.get_default('max_weight'), test_lines=None):
+  """Returns the counts and sums of the accuracies over the test samples, or
+     over the lines in test_lines."""
+  test_out_getter = TestOutGetterFromDir(test_out_dir)
+
+  input_iter = ReadInput(ar_pron_dict, test_file_name,
+                         test_out_getter, reachability_dir, test_lines)
+  summary = collections.OrderedDict([
+      ("num_of_reachable_samples", 0),
+      ("num_of_reachable_correct_samples", 0),
+      ("num_of_unreachable_samples", 0),
+      ("sum_reachable_correct_hard_accuracy", 0.0),
+      ("sum_reachable_correct_soft_accuracy", 0.0),
+      ("sum_hard_accuracy", 0.0),
+      ("sum_soft_accuracy", 0.0),
+  ])
   for test_result in input_iter:
-    results_at_n, correct_results_at_n = test_result.GetNumResultsAt(args.accuracy_at_n, args.max_weight)
+    results_at_n, correct_results_at_n = test_result.GetNumResultsAt(accuracy_at_n, max_weight)
     if results_at_n == 0:
-      num_of_unreachable_samples += 1
+      summary["num_of_unreachable_samples"] += 1
       continue
-    num_of_reachable_samples += 1
+    summary["num_of_reachable_samples"] += 1
     hard_accuracy = 1 if correct_results_at_n > 0 else 0
     soft_accuracy = correct_results_at_n / results_at_n
-    sum_hard_accuracy += hard_accuracy
-    sum_soft_accuracy += soft_accuracy
+    summary["sum_hard_accuracy"] += hard_accuracy
+    summary["sum_soft_accuracy"] += soft_accuracy
     if test_result.IsCorrectReachable():
-      num_of_reachable_correct_samples += 1
-      sum_reachable_correct_hard_accuracy += hard_accuracy
-      sum_reachable_correct_soft_accuracy += soft_accuracy
+      summary["num_of_reachable_correct_samples"] += 1
+      summary["sum_reachable_correct_hard_accuracy"] += hard_accuracy
+      summary["sum_reachable_correct_soft_accuracy"] += soft_accuracy
+  return summary
+
+def Objective(summary):
+  # Objective function - Reachable correct soft accuracy
+  return summary["sum_soft_accuracy"] / summary["num_of_reachable_correct_samples"]
+
+def main():
+  global args
+  args = parser.parse_args()
+  assert args.test_out_dir, "--test_out_dir is required"
+  print("Loading pronunciation dicts")
+  ar_pron_dict = LoadPronDict(args.ar_pronunciation_dict)
+  summary = Evaluate(ar_pron_dict, args.test_file_name, args.test_out_dir,
+                     args.reachability_dir, args.accuracy_at_n, args.max_weight,
+                     ReadLineNumbers(args.test_lines_file))
+  num_of_reachable_samples = summary["num_of_reachable_samples"]
+  num_of_reachable_correct_samples = summary["num_of_reachable_correct_samples"]
+  sum_hard_accuracy = summary["sum_hard_accuracy"]
+  sum_soft_accuracy = summary["sum_soft_accuracy"]
   print("SUMMARY:")
-  print("Number of unreachable samples:", num_of_unreachable_samples)
+  print("Number of unreachable samples:", summary["num_of_unreachable_samples"])
   print("Number of reachable samples:", num_of_reachable_samples)
   print("Number of reachable correct:", num_of_reachable_correct_samples)
   print("Total hard accuracy:", sum_hard_accuracy / num_of_reachable_samples)
   print("Total soft accuracy:", sum_soft_accuracy / num_of_reachable_samples)
   print("Reachable correct hard accuracy:", sum_hard_accuracy / num_of_reachable_correct_samples)
   print("Reachable correct soft accuracy:", sum_soft_accuracy / num_of_reachable_correct_samples)
-  # Objective function - Reachable correct soft accuracy
   print("\n\n\n")
-  print(sum_soft_accuracy / num_of_reachable_correct_samples)
+  print(Objective(summary))
 
 if __name__ == '__main__':
   main()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+# Exact line search and coordinate descent of the constraint weights over
+# the candidates that loanwords.py --candidates_dir writes.
+#
+# The cost of a candidate is the dot product of the weights with its
+# constraint violation counts. Along a line w + t * d the cost of every
+# candidate is linear in t, so the best candidates of a sample (the lower
+# envelope of the lines) change only where lines cross, and the accuracy is
+# piecewise constant between these breakpoints. The line search computes
+# the accuracy on every piece exactly, in one pass over the samples.
+
+"""
+./loanwords.py --test_file ../data/train.en-mt-it --in_ot_constraint_weights ../data/constraints/uniform.txt \
+               --candidates_dir candidates/round1 ...
+./line_search.py --candidates_dirs candidates/round1 --init_weights ../data/constraints/uniform.txt \
+                 --out_weights weights/line_search_round1
+"""
+import argparse
+import collections
+import json
+import os
+import numpy as np
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--candidates_dirs", nargs="+", required=True,
+                    help="Candidates of the same dev file, e.g. from several rounds. They are merged.")
+parser.add_argument("--init_weights", required=True)
+parser.add_argument("--out_weights", required=True)
+parser.add_argument("--default_weight", default=0.0, type=float)
+parser.add_argument("--max_step", default=1000.0, type=float,
+                    help="Largest increase of a weight in one line search.")
+parser.add_argument("--num_passes", default=10, type=int)
+parser.add_argument("--min_weight", default=0.0, type=float,
+                    help="Lower bound of the weights. Candidates dominated by another candidate "
+                         "are dropped only if it is above 0: a dominated candidate ties with the "
+                         "one dominating it when the weights they differ in are 0.")
+parser.add_argument("--no_compress", default=False, action="store_true",
+                    help="Keep the candidates that are dominated by another candidate.")
+parser.add_argument("--compressed_dir",
+                    help="Write the compressed candidates of every sample here. They can be "
+                         "read back with --candidates_dirs.")
+args = None  # Set in main.
+
+# Costs that differ by less than this (relative) are ties.
+EPSILON = 1e-9
+
+class Sample(object):
+  def __init__(self, violations, counts, num_correct):
+    """violations: num_vectors x num_constraints violation counts, counts and
+       num_correct: the number of candidates and of correct candidates with
+       each violation vector."""
+    self.violations = violations
+    self.counts = counts
+    self.num_correct = num_correct
+
+def MakeSample(candidates, index, compress=False):
+  """Makes a Sample of candidates (dicts with "violations" and "correct").
+  Candidates with the same violation vector are merged. With compress, the
+  vectors dominated by another vector (no smaller in any constraint) are
+  dropped. This is exact only if every weight is above 0: then they always
+  cost more than the vector that dominates them, while with a weight of 0
+  they can tie with it and count in the soft accuracy. Returns the Sample and, for every vector, its
+  candidates."""
+  by_vector = collections.OrderedDict()
+  for candidate in candidates:
+    vector = np.zeros(len(index))
+    for c, count in candidate["violations"].items():
+      vector[index[c]] = count
+    by_vector.setdefault(tuple(vector), []).append(candidate)
+  violations = np.array(list(by_vector.keys()))
+  groups = list(by_vector.values())
+  if compress:
+    dominated = np.zeros(len(violations), dtype=bool)
+    for i, v in enumerate(violations):
+      no_larger = np.all(violations <= v, axis=1)
+      smaller = np.any(violations < v, axis=1)
+      dominated[i] = np.any(no_larger & smaller)
+    violations = violations[~dominated]
+    groups = [g for g, d in zip(groups, dominated) if not d]
+  counts = np.array([len(g) for g in groups], dtype=float)
+  num_correct = np.array([sum(1 for c in g if c["correct"]) for g in groups], dtype=float)
+  return Sample(violations, counts, num_correct), groups
+
+def LoadWeightsFromFile(filename):
+  result = collections.OrderedDict()
+  for line in open(filename):
+    line = line.strip()
+    if len(line) == 0 or line.startswith("#"):
+      continue
+    key, weight = line.split("\t")
+    assert key not in result, key
+    result[key] = max(0.0, float(weight))
+  return result
+
+def LoadCandidates(dirnames, constraint_list=None, compress=False, compressed_dir=None):
+  """Returns the samples, the number of samples whose correct words are
+     reachable (the denominator of the objective of eval.py) and the
+     constraint list. Candidates of the same sample in several dirs are
+     merged, and with compress dominated candidates are dropped (see
+     MakeSample)."""
+  sample_candidates = collections.defaultdict(dict)
+  correct_reachable = {}
+  constraints = set(constraint_list or [])
+  for dirname in dirnames:
+    for sample_filename in os.listdir(dirname):
+      if sample_filename.endswith(".tmp"):
+        continue
+      with open(os.path.join(dirname, sample_filename)) as f:
+        header = json.loads(f.readline())
+        correct_reachable[sample_filename] = (correct_reachable.get(sample_filename, False) or
+                                              header["correct_reachable"])
+        for line in f:
+          candidate = json.loads(line)
+          key = (candidate["ar_word"], tuple(sorted(candidate["violations"].items())))
+          sample_candidates[sample_filename][key] = candidate
+          constraints.update(candidate["violations"])
+  if constraint_list is None:
+    constraint_list = sorted(constraints)
+  else:
+    constraint_list = list(constraint_list) + sorted(constraints - set(constraint_list))
+  index = {c: i for i, c in enumerate(constraint_list)}
+  samples = []
+  num_candidates = 0
+  for sample_filename, candidates in sorted(sample_candidates.items()):
+    if not candidates:
+      continue
+    sample, groups = MakeSample(candidates.values(), index, compress)
+    samples.append(sample)
+    num_candidates += len(candidates)
+    if compressed_dir:
+      WriteCandidates(os.path.join(compressed_dir, sample_filename),
+                      correct_reachable[sample_filename], groups)
+  print("Candidates: {}, violation vectors: {}".format(
+      num_candidates, sum(len(s.violations) for s in samples)))
+  num_reachable_correct = sum(1 for v in correct_reachable.values() if v)
+  return samples, num_reachable_correct, constraint_list
+
+def WriteCandidates(filename, correct_reachable, groups):
+  """Writes candidates in the format of loanwords.py --candidates_dir."""
+  with open(filename + ".tmp", "w") as f:
+    f.write(json.dumps({"correct_reachable": correct_reachable}) + "\n")
+    for group in groups:
+      for candidate in group:
+        f.write(json.dumps(candidate, sort_keys=True) + "\n")
+  os.rename(filename + ".tmp", filename)
+
+def Ties(costs):
+  best = costs.min()
+  return costs <= best + EPSILON * (1 + abs(best))
+
+def Accuracy(samples, w, num_reachable_correct):
+  """Soft accuracy at 1, as eval.py computes it: the fraction of correct
+     candidates among the best ones, summed over the samples."""
+  total = 0.0
+  for sample in samples:
+    best = Ties(sample.violations.dot(w))
+    total += sample.num_correct[best].sum() / sample.counts[best].sum()
+  return total / num_reachable_correct
+
+def Envelope(a, b, t_min, t_max):
+  """Returns the pieces [(t_start, best candidates)] of the lower envelope
+     of the lines a + b * t on [t_min, t_max). The best candidates of a piece
+     are the ones on the envelope right after t_start."""
+  pieces = []
+  t = t_min
+  while True:
+    ties = np.nonzero(Ties(a + b * t))[0]
+    min_slope = b[ties].min()
+    best = ties[b[ties] <= min_slope + EPSILON * (1 + abs(min_slope))]
+    pieces.append((t, best))
+    c = best[0]
+    steeper = b < b[c] - EPSILON * (1 + abs(b[c]))
+    if not steeper.any():
+      return pieces
+    crossings = (a[steeper] - a[c]) / (b[c] - b[steeper])
+    t_next = max(t, crossings.min())
+    if t_next >= t_max:
+      return pieces
+    if t_next == t:
+      # The steeper lines tie at t within the tolerance, but are not on
+      # the envelope yet; step past them.
+      t_next = np.nextafter(t, t_max)
+    t = t_next
+
+def LineSearch(samples, w, d, t_min, t_max, num_reachable_correct):
+  """Returns (t, accuracy) of the best piece of the accuracy along w + t * d
+     on [t_min, t_max]. t is the middle of the piece; of equally accurate
+     pieces, the one closest to t = 0 is taken."""
+  events = collections.defaultdict(float)
+  for sample in samples:
+    a = sample.violations.dot(w)
+    b = sample.violations.dot(d)
+    prev_value = 0.0
+    for t_start, best in Envelope(a, b, t_min, t_max):
+      value = sample.num_correct[best].sum() / sample.counts[best].sum()
+      events[t_start] += value - prev_value
+      prev_value = value
+  breakpoints = sorted(events) + [t_max]
+  best_t, best_accuracy = None, None
+  accuracy = 0.0
+  for t_start, t_end in zip(breakpoints, breakpoints[1:]):
+    accuracy += events[t_start]
+    if t_end <= t_start:
+      continue
+    t = (t_start + t_end) / 2
+    if t_start < 0 < t_end:
+      t = 0.0
+    score = accuracy / num_reachable_correct
+    if (best_accuracy is None or score > best_accuracy + EPSILON or
+        (score >= best_accuracy - EPSILON and abs(t) < abs(best_t))):
+      best_t, best_accuracy = t, score
+  return best_t, best_accuracy
+
+def CoordinateDescent(samples, w, num_reachable_correct, max_step, num_passes, min_weight=0.0):
+  """Line searches along every weight in turn, until a pass does not
+     improve the accuracy. The weights stay at least min_weight."""
+  w = np.array(w, dtype=float)
+  accuracy = Accuracy(samples, w, num_reachable_correct)
+  print("Initial accuracy:", accuracy)
+  for p in range(num_passes):
+    improved = False
+    for k in range(len(w)):
+      d = np.zeros(len(w))
+      d[k] = 1.0
+      t, t_accuracy = LineSearch(samples, w, d, min_weight - w[k], max_step, num_reachable_correct)
+      if t_accuracy > accuracy + EPSILON:
+        w[k] += t
+        accuracy = t_accuracy
+        improved = True
+        print("Pass {} weight {}: {} accuracy: {}".format(p, k, w[k], accuracy))
+    if not improved:
+      break
+  return w, accuracy
+
+def main():
+  global args
+  args = parser.parse_args()
+  init_weights = LoadWeightsFromFile(args.init_weights)
+  if args.compressed_dir:
+    os.makedirs(args.compressed_dir, exist_ok=True)
+  compress = not args.no_compress and args.min_weight > 0
+  if not compress and not args.no_compress:
+    print("Not compressing the candidates: --min_weight is not above 0")
+  samples, num_reachable_correct, constraint_list = LoadCandidates(
+      args.candidates_dirs, list(init_weights), compress=compress,
+      compressed_dir=args.compressed_dir)
+  print("Loaded {} samples, {} reachable correct, {} constraints".format(
+      len(samples), num_reachable_correct, len(constraint_list)))
+  w = [max(args.min_weight, init_weights.get(c, args.default_weight)) for c in constraint_list]
+  w, accuracy = CoordinateDescent(samples, w, num_reachable_correct,
+                                  args.max_step, args.num_passes, args.min_weight)
+  print("Final accuracy on the candidates:", accuracy)
+  with open(args.out_weights, "w") as f:
+    for c, weight in zip(constraint_list, w):
+      f.write("{}\t{}\n".format(c, weight))
+
+if __name__ == '__main__':
+  main()
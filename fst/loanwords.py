@@ -4,11 +4,13 @@
 import phone_transducer as pt
 import syllabification, morphology
 import operations, ot_constraints
+import artifacts, vocab_groups
+import multi_decode
 import collections
 import hashlib
-import math
+import json
 import argparse
-import sys, os, glob
+import sys, os
 import time
 import operator
 from functools import reduce
@@ -23,26 +25,72 @@ parser.add_argument('--sw_pronunciation_dict')
 parser.add_argument('--remove_meta_arcs', default=False, action='store_true')
 parser.add_argument('--with_syllabification', default=False, action='store_true')
 parser.add_argument('--only_initialize_transducers', default=False, action='store_true')
+parser.add_argument('--only_reachability_index', default=False, action='store_true',
+                    help='Only build the reachability index of the test file (the AR words that '
+                         'reach each SW word): no samples are saved or decoded, and the lines '
+                         'already in the index are skipped. Requires --remove_meta_arcs.')
+parser.add_argument('--precompose_constraints', default=False, action='store_true',
+                    help='Compose the operations with a single minimized product of all OT constraints.')
+parser.add_argument('--specialize_output_alphabet', default=False, action='store_true',
+                    help='Trim loanwords.tr to the SW letters of each sample before composing.')
+parser.add_argument('--specialization_cache_mb', default=128, type=int,
+                    help='Memory for the specialized copies of loanwords.tr kept in a worker, in MB.')
+parser.add_argument('--constraints_on_sw_vocab', default=False, action='store_true',
+                    help='Keep only the operations in loanwords.tr and apply syllabification '
+                         'and the OT constraints to the per-word SW vocab.')
 
 parser.add_argument('--in_ot_constraint_weights')
 parser.add_argument('--out_ot_constraint_weights')
 parser.add_argument('--default_weight', default=0.0, type=float)
 
 parser.add_argument('--min_consonant_count', default=1, type=int)
+parser.add_argument('--max_edits', type=int,
+                    help='Maximum number of applications of each operation per word.')
+parser.add_argument('--max_cascade_edits', type=int,
+                    help='Maximum number of operation applications per word in the loanwords cascade.')
 parser.add_argument('--shortest_sw_word_len', default=3, type=int)
 parser.add_argument('--start_line', default=0, type=int)
+parser.add_argument('--test_lines_file',
+                    help='File with the numbers of the lines of --test_file to use, one per line.')
 parser.add_argument('--worker_id', default=0, type=int)
 parser.add_argument('--num_workers', default=1, type=int)
+parser.add_argument('--init_jobs', default=1, type=int,
+                    help='Number of processes that build the cached transducers.')
+parser.add_argument('--skip_unreachable_correct', default=False, action='store_true',
+                    help='Skip samples that are not reachable from their correct AR words. '
+                         'They do not change the objective of eval.py.')
+parser.add_argument('--no_reachability_precheck', default=False, action='store_true',
+                    help='Do not check reachability on unweighted acceptors before composing the vocab.')
+parser.add_argument('--vocab_cache_mb', default=256, type=int,
+                    help='Memory for the AR vocab groups kept in a worker, in MB.')
 
 parser.add_argument('--num_predicted_best_paths', default=1, type=int)
+parser.add_argument('--candidates_dir',
+                    help='Write the constraint violations of the best paths of each sample here, '
+                         'for line_search.py. Requires meta arcs.')
+parser.add_argument('--num_candidates', default=100, type=int)
+parser.add_argument('--decode_weights_files', nargs='+',
+                    help='Decode the samples with all these constraint weights files in one pass, '
+                         'writing the best path to one test_out_dir per file. Requires meta arcs, '
+                         'and cannot be combined with --num_predicted_best_paths > 1 or '
+                         '--candidates_dir.')
 parser.add_argument('--minimize_final_transducer', action='store_true')
-args = parser.parse_args()
+parser.add_argument('--prune_at_best_correct', default=False, action='store_true',
+                    help='Accuracy@1 decoding: find only the best paths, pruning the vocab at the '
+                         'cost of the best path so far. Requires --remove_meta_arcs.')
+args = None  # Set by ParseArgs.
+
+def ParseArgs(argv=None):
+  global args
+  args = parser.parse_args(argv)
+  return args
 
 
 class DirNames(object):
   def __init__(self, base_dir, ar_pron_dict_file_name, test_file_name,
-               add_meta_arc, with_syllabification):
-    self.syms_hash = self.SetHash(pt.abc.ALL_SYMS)
+               add_meta_arc, with_syllabification, constraints_on_sw_vocab=False,
+               max_edits=None, max_cascade_edits=None):
+    self.syms_hash = self.SetHash(pt.syms.items())
     self.ar_pron_dict_hash = self.FileHash(ar_pron_dict_file_name)
     if not add_meta_arc:
       self.weights_hash = self.DictHash(pt.abc.OT_CONSTRAINTS)
@@ -55,16 +103,22 @@ class DirNames(object):
     reachable_paths_dir = os.path.join(self.base_dir, "reachable_paths")
     depends_on_meta_dir = os.path.join(depends_on_syms_dir, "with_meta_" + str(add_meta_arc).lower())
     depends_on_weights = os.path.join(depends_on_meta_dir, "weight_" +self.weights_hash)
+    if max_edits is not None or max_cascade_edits is not None:
+      # An edit budget reaches fewer AR words, so its reachability index is
+      # kept apart from the index of the full search.
+      edits_dir = "max_edits_{}_{}".format(max_edits, max_cascade_edits)
+      depends_on_weights = os.path.join(depends_on_weights, edits_dir)
+      reachable_paths_dir = os.path.join(reachable_paths_dir, edits_dir)
+    if constraints_on_sw_vocab:
+      depends_on_weights = os.path.join(depends_on_weights, "constraints_on_sw_vocab")
     if with_syllabification:
       depends_on_syllabification = os.path.join(depends_on_weights, "with_syllabification")
     else:
       depends_on_syllabification = depends_on_weights
     self.paths = {
         'reachable_test_dir' : os.path.join(reachable_paths_dir, self.test_file_hash),
-        'loanwords_tr' : os.path.join(depends_on_syllabification, 'loanwords.tr'),
-        'ar_post_tr' : os.path.join(depends_on_weights, 'ar_post.tr'),
-        'sw_pre_tr' : os.path.join(depends_on_syllabification, 'sw_pre.tr'),
-        'ar_vocab_dir' : os.path.join(depends_on_syms_dir, 'ar_vocab_' + self.ar_pron_dict_hash),
+        # Tracked artifacts, keyed by exactly the inputs they are built from.
+        'artifacts_dir' : os.path.join(depends_on_meta_dir, 'artifacts'),
         'test_samples_dir' : os.path.join(depends_on_syllabification, 'test_samples_' + self.test_file_hash),
         'test_out_dir' : os.path.join(depends_on_syllabification, 'test_out_' + self.test_file_hash),
     }
@@ -96,7 +150,7 @@ class DirNames(object):
 
 def LoadWeightsFromFile(filename):
   def default_weight():
-    return args.default_weight
+    return max(0.0, args.default_weight)
   result = collections.defaultdict(default_weight)
   if filename and os.path.isfile(filename):
     for line in open(filename):
@@ -115,74 +169,260 @@ def SaveWeightsToFile(weight_dict, filename):
       f.write("{}\t{}\n".format(k, v))
     os.rename(filename + ".tmp", filename)
 
-def LoadVocabFromFile(pron_dict, limit=None, group_size=5000, transducer_file_pattern=None):
-  """Returns a transducer that accepts and outputs all words in the input file."""
-  #Load and return groups of minimized ar_vocab transducers (if exist)
-  filenames = list(glob.iglob(transducer_file_pattern))
-  if len(filenames) > 0 :
-    all_transducers = [LoadTransducerFromFile(f) for f in filenames]
-    return all_transducers, True
-
-  print("Loading the vocab file")
-  vocab = set()
-  for word, ipa_pron_set in pron_dict.items():
-    for ipa_pron in ipa_pron_set:
-      vocab.add(ipa_pron)  # ipa_pron is tuple('d', 'o̯', 'e̯')
-    if limit is not None and len(vocab) > limit:
-      break
-
-  print("Checking missing letters in Alphabet")
-  seen_letters = set()
-  for w in vocab:
-    seen_letters.update(set(w))
-  missing_letters = seen_letters - pt.abc.ALL_LETTERS
-  assert len(missing_letters) == 0, missing_letters
-
-  print("Building transducer")
-  print("Vocab size:", len(vocab), "num groups:", math.ceil(len(vocab) / group_size))
-
-  all_transducers = []
-  for i, w in enumerate(vocab):
-    if i % group_size == 0:
-      print(".", sep="", end="")
-      t = pt.Transducer()
-      all_transducers.append(t)
+def VocabGroupTransducer(words):
+  """Returns a minimized transducer that accepts and outputs all words."""
+  t = pt.Transducer()
+  for w in words:
     t.set_union(pt.linear_chain(w))
-  print()
-  return all_transducers, False
+  return pt.Minimize(t)
+
+def ArPostVocabGroupTransducer(ar_vocab_file, ar_post_file):
+  ar_vocab = LoadTransducerFromFile(ar_vocab_file)
+  ar_vocab.arc_sort_output()
+  ar_vocab = ar_vocab >> LoadTransducerFromFile(ar_post_file)
+  ar_vocab = pt.MinimizeEncoded(ar_vocab)
+  ar_vocab.arc_sort_output()
+  return ar_vocab
+
+def ArPostVocabAcceptor(ar_post_vocab_file):
+  """Unweighted minimized acceptor of the AR vocab group after ar_post, for
+     the reachability pre-check."""
+  acceptor = pt.UnweightedAcceptor(LoadTransducerFromFile(ar_post_vocab_file),
+                                   project_output=True)
+  acceptor.arc_sort_input()
+  return acceptor
+
+def ArPostTransducer(add_meta_arc=True, with_syllabification=False):
+  print("Building AR morphology and vowel deletion")
+  transducers = [
+      morphology.ar_morphology_transducer(add_meta_arc=add_meta_arc, with_syllabification=with_syllabification), 
+      operations.vowel_deletion_transducer(add_meta_arc=add_meta_arc, max_edits=args.max_edits),
+      operations.min_consonant_count_transducer(
+          min_consonant_count=args.min_consonant_count, add_meta_arc=add_meta_arc),
+  ]
+  ar_post_transducer = pt.Compose(transducers, add_meta_arc=add_meta_arc)
+  ar_post_transducer.arc_sort_input()
+  return ar_post_transducer
 
-def ComposeAllTransducers(add_meta_arc=True, with_syllabification=False, only_init=False):
-  print("  initializing transducers")
+def SwPreTransducer(add_meta_arc=True, with_syllabification=False):
+  print("Building SW morphology transducer")
+  transducers = [
+      #pt.accept_all_transducer(), # Remove this one if adding more.
+      morphology.sw_morphology_transducer(add_meta_arc=add_meta_arc, with_syllabification=with_syllabification),
+
+  ]
+  sw_pre_transducer = pt.Compose(transducers, add_meta_arc=add_meta_arc)
+  sw_pre_transducer.arc_sort_output()
+  return sw_pre_transducer
+
+def TransducerArtifact(dirnames, name, build, deps=(), inputs=(), modules=()):
+  """An artifact written from the transducer that build() returns. It is
+     keyed by the sources of modules and of the modules that define the
+     builders, the inputs (flags), the files of deps and the alphabet fields
+     and OT weights that build() reads."""
+  def Write(tmp_filename):
+    build().write(tmp_filename, True, True)
+  modules = [pt, pt.alphabet, sys.modules[__name__], sys.modules[build.__module__],
+             vocab_groups] + list(modules)
+  modules = list(collections.OrderedDict((m.__file__, m) for m in modules).values())
+  inputs = [artifacts.SourceHash(m) for m in modules] + list(inputs)
+  return artifacts.TrackedArtifact(name, dirnames.paths['artifacts_dir'], Write, pt.abc,
+                                   deps=deps, inputs=inputs)
+
+def InitArtifacts(dirnames, add_meta_arc, with_syllabification, ar_pron_dict=None):
+  """Returns the cached transducers as a graph of artifacts. The AR vocab
+     groups composed with ar_post are added if ar_pron_dict is given."""
+  result = []
+  loanwords_deps = []
+  if args.precompose_constraints:
+    constraints = TransducerArtifact(
+        dirnames, 'constraints', lambda: ConstraintsTransducer(add_meta_arc=add_meta_arc),
+        modules=[ot_constraints])
+    result.append(constraints)
+    loanwords_deps.append(constraints)
+
+  def BuildLoanwords():
+    constraints_transducer = None
+    if args.precompose_constraints:
+      constraints_transducer = LoadTransducerFromFile(constraints.Filename())
+    return ComposeAllTransducers(add_meta_arc=add_meta_arc, with_syllabification=with_syllabification,
+                                 constraints_transducer=constraints_transducer,
+                                 operations_only=args.constraints_on_sw_vocab,
+                                 max_edits=args.max_edits,
+                                 max_cascade_edits=args.max_cascade_edits)
+
+  ar_post = TransducerArtifact(
+      dirnames, 'ar_post', lambda: ArPostTransducer(add_meta_arc, with_syllabification),
+      inputs=[with_syllabification, args.max_edits, args.min_consonant_count],
+      modules=[morphology, operations])
+  result.extend([
+      TransducerArtifact(
+          dirnames, 'loanwords', BuildLoanwords, deps=loanwords_deps,
+          inputs=[with_syllabification, args.constraints_on_sw_vocab,
+                  args.max_edits, args.max_cascade_edits],
+          modules=[operations, ot_constraints, syllabification]),
+      ar_post,
+      TransducerArtifact(
+          dirnames, 'sw_pre', lambda: SwPreTransducer(add_meta_arc, with_syllabification),
+          inputs=[with_syllabification], modules=[morphology]),
+  ])
+  if ar_pron_dict is None:
+    return result
+
+  ar_post_vocab_groups = []
+  group_stats = []
+  hard = vocab_groups.HardConsonants()
+  for i, words in vocab_groups.PartitionVocab(ar_pron_dict):
+    ar_vocab = TransducerArtifact(
+        dirnames, "ar_vocab_group_{}".format(i),
+        lambda words=words: VocabGroupTransducer(words),
+        inputs=[artifacts.Hash(words)])
+    ar_post_vocab = TransducerArtifact(
+        dirnames, "ar_post_vocab_group_{}".format(i),
+        lambda ar_vocab=ar_vocab: ArPostVocabGroupTransducer(
+            ar_vocab.Filename(), ar_post.Filename()),
+        deps=[ar_vocab, ar_post])
+    ar_post_vocab_acceptor = TransducerArtifact(
+        dirnames, "ar_post_vocab_acceptor_{}".format(i),
+        lambda ar_post_vocab=ar_post_vocab: ArPostVocabAcceptor(ar_post_vocab.Filename()),
+        deps=[ar_post_vocab])
+    result.extend([ar_vocab, ar_post_vocab, ar_post_vocab_acceptor])
+    ar_post_vocab_groups.append((ar_post_vocab, ar_post_vocab_acceptor))
+    group_stats.append(vocab_groups.GroupStats.FromWords(words, hard))
+
+  def WriteGroups(tmp_filename):
+    with open(tmp_filename, "w") as f:
+      for (group, acceptor), stats in zip(ar_post_vocab_groups, group_stats):
+        metadata = {"file": group.Filename(), "acceptor": acceptor.Filename(),
+                    "stats": stats.ToDict()}
+        f.write("{}\n".format(json.dumps(metadata, sort_keys=True)))
+  # Lists the files and the profile stats of all groups, so it is done when
+  # they all are.
+  result.append(artifacts.TrackedArtifact(
+      'ar_post_vocab', dirnames.paths['artifacts_dir'], WriteGroups, pt.abc,
+      deps=[a for group in ar_post_vocab_groups for a in group],
+      inputs=[[s.ToDict() for s in group_stats]],
+      suffix=".json"))
+  return result
+
+# The AR vocab groups that a warm worker (see objective.py) read last, by the
+# filename of their list.
+_loaded_ar_vocab_groups = {}
+
+def LoadArPostVocabGroups(filename, max_bytes):
+  """Returns a provider of the AR vocab groups composed with ar_post, listed
+     in filename, that keeps at most max_bytes of them in memory."""
+  def Load(group_filename):
+    t = LoadTransducerFromFile(group_filename)
+    t.arc_sort_output()
+    return t
+  groups = []
+  for line in open(filename):
+    metadata = json.loads(line)
+    groups.append((metadata["file"], metadata["acceptor"],
+                   vocab_groups.GroupStats.FromDict(metadata["stats"])))
+  return vocab_groups.VocabGroupProvider(groups, Load, max_bytes)
+
+def ConstraintsTransducer(add_meta_arc=True):
+  """Intersects all OT constraint acceptors into one minimized machine.
+
+  With meta arcs the constraints are not strict acceptors (they emit rule
+  names), so the product is built by composition and minimized over encoded
+  label pairs."""
+  print("  intersecting OT constraints")
+  product = pt.Compose(ot_constraints.constraint_transducers(add_meta_arc=add_meta_arc),
+                       add_meta_arc=add_meta_arc)
+  print("  minimizing OT constraints product, size:", len(product))
+  product = pt.MinimizeEncoded(product)
+  product.arc_sort_input()
+  print("  minimized OT constraints product, size:", len(product))
+  return product
+
+def OperationTransducers(add_meta_arc=True, max_edits=None, max_cascade_edits=None):
+  edit_marker = max_cascade_edits is not None
   transducers = [
       # All Operations go here.
-      operations.degemination_transducer(add_meta_arc=add_meta_arc),
-      operations.phone_substitution_transducer(add_meta_arc=add_meta_arc),
-      operations.epenthesis_transducer(add_meta_arc=add_meta_arc),
+      operations.degemination_transducer(add_meta_arc=add_meta_arc, max_edits=max_edits,
+                                         edit_marker=edit_marker),
+      operations.phone_substitution_transducer(add_meta_arc=add_meta_arc, max_edits=max_edits,
+                                               edit_marker=edit_marker),
+      operations.epenthesis_transducer(add_meta_arc=add_meta_arc, max_edits=max_edits,
+                                       edit_marker=edit_marker),
       operations.final_vowel_substitution_transducer(add_meta_arc=add_meta_arc),
-
-      syllabification.syllabification_transducer(add_meta_arc=add_meta_arc),
-
-      # All OT Constraints transducers here.
-      ot_constraints.nocoda_transducer(add_meta_arc=add_meta_arc),
-      ot_constraints.no_complex_transducer(add_meta_arc=add_meta_arc),
-      ot_constraints.no_complex_margin_transducer(add_meta_arc=add_meta_arc),
-      ot_constraints.no_complex_vow_transducer(add_meta_arc=add_meta_arc),
-      ot_constraints.onset_transducer(add_meta_arc=add_meta_arc),
-      ot_constraints.peak_transducer(add_meta_arc=add_meta_arc),
-      ot_constraints.ssp_transducer(add_meta_arc=add_meta_arc),
-      ot_constraints.length_transducer(add_meta_arc=add_meta_arc),
   ]
+  if edit_marker:
+    # Markers of the earlier operations pass through the later ones and are
+    # counted (and removed) at the end of the cascade.
+    transducers[1:] = [pt.AddEditMarkerArcs(t) for t in transducers[1:]]
+    transducers.append(operations.edit_budget_transducer(max_cascade_edits, add_meta_arc=add_meta_arc))
+  return transducers
+
+def RecipientTransducers(add_meta_arc=True, with_syllabification=False,
+                         constraints_transducer=None):
+  """Syllabification, OT constraints and unsyllabification. These stages only
+  look at the SW (output) side of the mapping."""
+  transducers = [syllabification.syllabification_transducer(add_meta_arc=add_meta_arc)]
+  if constraints_transducer is None:
+    # All OT Constraints transducers here.
+    transducers.extend(ot_constraints.constraint_transducers(add_meta_arc=add_meta_arc))
+  else:
+    transducers.append(constraints_transducer)
   if not with_syllabification:
     transducers.append(syllabification.unsyllabification_transducer(add_meta_arc=add_meta_arc))
-  #"""
+  return transducers
 
-  if only_init:
-    return None
-
-  combined = pt.Compose(transducers, add_meta_arc=add_meta_arc)
+def ComposeAllTransducers(add_meta_arc=True, with_syllabification=False,
+                          constraints_transducer=None, operations_only=False,
+                          max_edits=None, max_cascade_edits=None):
+  print("  initializing transducers")
+  transducers = OperationTransducers(add_meta_arc=add_meta_arc, max_edits=max_edits,
+                                     max_cascade_edits=max_cascade_edits)
+  if not operations_only:
+    transducers.extend(RecipientTransducers(add_meta_arc=add_meta_arc,
+                                            with_syllabification=with_syllabification,
+                                            constraints_transducer=constraints_transducer))
+
+  has_pass_through = []
+  if constraints_transducer is not None:
+    has_pass_through.append(constraints_transducer)
+  combined = pt.Compose(transducers, add_meta_arc=add_meta_arc, has_pass_through=has_pass_through)
   combined.arc_sort_output()
   return combined
 
+class SpecializedTransducers(object):
+  """Copies of a transducer trimmed to the output letters of a sample,
+  memoized by the letter set so that similar words reuse them. The recently
+  used copies are kept, up to max_bytes. Their size is estimated from their
+  numbers of states and arcs."""
+  STATE_BYTES = 32
+  ARC_BYTES = 16
+
+  def __init__(self, transducer, max_bytes):
+    self.transducer = transducer
+    self.max_bytes = max_bytes
+    self.cache = collections.OrderedDict()
+    self.cached_bytes = 0
+
+  def Get(self, letters):
+    signature = tuple(sorted(letters & pt.abc.ALL_LETTERS))
+    if signature in self.cache:
+      self.cache.move_to_end(signature)
+      return self.cache[signature][0]
+    specialized = pt.SpecializeOutputLetters(self.transducer, set(signature))
+    specialized.arc_sort_output()
+    print("    specialized to {} letters, size: {}".format(len(signature), len(specialized)))
+    size = len(specialized) * self.STATE_BYTES + specialized.num_arcs() * self.ARC_BYTES
+    self.cache[signature] = (specialized, size)
+    self.cached_bytes += size
+    # The copy just built stays, even if it is larger than max_bytes.
+    while self.cached_bytes > self.max_bytes and len(self.cache) > 1:
+      _, (_, evicted_size) = self.cache.popitem(last=False)
+      self.cached_bytes -= evicted_size
+    return specialized
+
+# Paths whose costs differ by less than this are ties.
+PRUNE_DELTA = 1e-6
+
 class TrainingSample(object):
   def __init__(self, sw_w, sw_pron_list, ar_word_list):
     self.sw_word = sw_w
@@ -190,15 +430,35 @@ class TrainingSample(object):
     self.ar_word_list = ar_word_list
     print("sw_pron_list=", sw_pron_list)
 
-  def ApplyLoanwords(self, ar_vocab_groups, loanwords_transducer,
-                     sw_pre_transducer, add_meta_arc, with_syllabification):
-    time_a = time.time()
+  def SwWordTransducer(self, add_meta_arc, with_syllabification):
     sw_word_transducer = pt.UnionLinearChains(self.sw_pron_list)
     if add_meta_arc:
       pt.AddPassThroughArcs(sw_word_transducer)
     if with_syllabification:
       pt.AddSyllabificationArcs(sw_word_transducer)
     sw_word_transducer.arc_sort_input()
+    return sw_word_transducer
+
+  def SwVocab(self, sw_word_transducer, sw_pre_transducer, recipient_transducers=None):
+    time_b = time.time()
+    print("  sw_pre_transducer")
+    sw_vocab = sw_pre_transducer >> sw_word_transducer
+    sw_vocab.arc_sort_input()
+    time_c = time.time()
+    print("    applying sw_pre_transducer took:", time_c-time_b, "sec")
+
+    if recipient_transducers:
+      print("  recipient_transducers")
+      sw_vocab = pt.ComposeRightToLeft(recipient_transducers, sw_vocab)
+      time_r = time.time()
+      print("    applying recipient_transducers took:", time_r-time_c, "sec")
+    return sw_vocab
+
+  def ApplyLoanwords(self, ar_vocab_groups, loanwords_transducer,
+                     sw_pre_transducer, add_meta_arc, with_syllabification,
+                     recipient_transducers=None, specialized_loanwords=None):
+    time_a = time.time()
+    sw_word_transducer = self.SwWordTransducer(add_meta_arc, with_syllabification)
     time_sw = time.time()
     print("    building SW transducer took:", time_sw-time_a, "sec")
 
@@ -207,11 +467,20 @@ class TrainingSample(object):
     time_b = time.time()
     print("    building AR transducer took:", time_b-time_sw, "sec")
 
-    print("  sw_pre_transducer")
-    sw_vocab = sw_pre_transducer >> sw_word_transducer
-    sw_vocab.arc_sort_input()
+    sw_vocab = self.SwVocab(sw_word_transducer, sw_pre_transducer, recipient_transducers)
     time_c = time.time()
-    print("    applying sw_pre_transducer took:", time_c-time_b, "sec")
+
+    bounds = vocab_groups.DonorBounds(self.sw_pron_list, max_edits=args.max_edits)
+    groups = [group for group in ar_vocab_groups if not bounds.Skip(group.stats)]
+    print("    skipped {} vocab groups out of bounds".format(len(ar_vocab_groups) - len(groups)))
+    if not groups:
+      print("    no vocab groups left, NOT reachable")
+      self.SetUnreachable()
+      return
+
+    if specialized_loanwords is not None:
+      print("  specializing loanwords")
+      loanwords_transducer = specialized_loanwords.Get(pt.InputSymbols(sw_vocab))
 
     print("  loanwords")
     combined = loanwords_transducer >> sw_vocab
@@ -219,12 +488,25 @@ class TrainingSample(object):
     time_d = time.time()
     print("    applying loanwords took:", time_d-time_c, "sec")
 
+    if not args.no_reachability_precheck:
+      print("  reachability pre-check")
+      num_groups = len(groups)
+      groups = self.ReachableGroups(groups, combined)
+      time_p = time.time()
+      print("    reachability pre-check took:", time_p-time_d, "sec,",
+            "{} of {} vocab groups left".format(len(groups), num_groups))
+      time_d = time_p
+      if not groups:
+        print("    unweighted pre-check, NOT reachable")
+        self.SetUnreachable()
+        return
+
     print("  ar_vocab")
     self.t_all = pt.Transducer()
-    for ar_vocab in ar_vocab_groups:
+    for group in groups:
       print(".", sep="", end="")
       sys.stdout.flush()
-      self.t_all.set_union(ar_vocab >> combined)
+      self.t_all.set_union(group.transducer >> combined)
     print()
     self.t_all.arc_sort_input()
     time_e = time.time()
@@ -238,6 +520,93 @@ class TrainingSample(object):
     print("    building t_correct took:", time_g-time_e, "sec")
     print("    total ApplyLoanwords took:", time_g-time_a, "sec")
 
+  def DecodeAt1(self, ar_vocab_groups, ar_post_transducer, loanwords_transducer,
+                sw_pre_transducer, with_syllabification, recipient_transducers=None,
+                specialized_loanwords=None):
+    """Finds only the best paths, for accuracy@1. The vocab groups are
+       composed with the SW side pruned at the cost of the best path found so
+       far, starting from the best correct path. Sets t_all to the best
+       correct path and the best path of every group that ties with the
+       best cost, so that Test() breaks the ties as it does on the full
+       lattice, and t_correct to the paths of the correct words."""
+    time_a = time.time()
+    sw_word_transducer = self.SwWordTransducer(False, with_syllabification)
+    sw_vocab = self.SwVocab(sw_word_transducer, sw_pre_transducer, recipient_transducers)
+    if specialized_loanwords is not None:
+      loanwords_transducer = specialized_loanwords.Get(pt.InputSymbols(sw_vocab))
+    print("  loanwords")
+    combined = loanwords_transducer >> sw_vocab
+    combined.arc_sort_input()
+
+    print("  t_correct")
+    if not self.ar_word_list:
+      self.SetUnreachable()
+      return
+    ar_vocab = pt.UnionLinearChains(self.ar_word_list)
+    ar_vocab.arc_sort_output()
+    ar_vocab = ar_vocab >> ar_post_transducer
+    ar_vocab.arc_sort_output()
+    self.t_correct = ar_vocab >> combined
+    best_cost = pt.BestPathCost(self.t_correct)
+    if best_cost is None:
+      print("    NOT reachable from CORRECT AR words")
+      self.t_all = pt.Transducer()
+      return
+    print("    best correct cost:", best_cost)
+    best_paths = [self.t_correct.shortest_path(1)]
+
+    def PruneCombined():
+      # The weights are non-negative (LoadWeightsFromFile clamps them), so
+      # no path through the pruned arcs can cost less than best_cost.
+      combined.prune(best_cost - pt.BestPathCost(combined) + PRUNE_DELTA)
+      combined.connect()
+      combined.arc_sort_input()
+
+    PruneCombined()
+    bounds = vocab_groups.DonorBounds(self.sw_pron_list, max_edits=args.max_edits)
+    num_composed = 0
+    for group in ar_vocab_groups:
+      if bounds.Skip(group.stats):
+        continue
+      num_composed += 1
+      t = group.transducer >> combined
+      cost = pt.BestPathCost(t)
+      if cost is None or cost > best_cost + PRUNE_DELTA:
+        continue
+      if cost < best_cost - PRUNE_DELTA:
+        print("    better path with cost {} in vocab group {}".format(cost, num_composed))
+        best_cost = cost
+        best_paths = []
+        PruneCombined()
+      best_paths.append(t.shortest_path(1))
+    self.t_all = best_paths[0]
+    for t in best_paths[1:]:
+      self.t_all.set_union(t)
+    self.t_all.arc_sort_output()
+    print("    composed {} vocab groups, {} tied best paths, DecodeAt1 took: {} sec".format(
+        num_composed, len(best_paths), time.time() - time_a))
+
+  def ReachableGroups(self, groups, combined):
+    """Returns the groups that have a word in the input of combined, by an
+       unweighted check on minimized acceptors. The other groups compose to
+       an empty transducer. Groups without an acceptor are kept."""
+    reachable_inputs = pt.UnweightedAcceptor(combined)
+    reachable_inputs.arc_sort_input()
+    result = []
+    for group in groups:
+      if group.acceptor is None:
+        result.append(group)
+        continue
+      common = group.acceptor & reachable_inputs
+      common.connect()
+      if len(common) > 0:
+        result.append(group)
+    return result
+
+  def SetUnreachable(self):
+    self.t_all = pt.Transducer()
+    self.t_correct = pt.Transducer()
+
   def Write(self, file_prefix):
    self.t_correct.write(file_prefix + "t_correct.tr", True, True)
    self.t_all.write(file_prefix + "t_all.tr", True, True)
@@ -252,7 +621,8 @@ class TrainingSample(object):
 def MakeSample(sample_file_prefix, ar_words_to_sample_filename, sw_w, sw_pron_list,
                ar_correct_words, ar_vocab_groups, ar_post_transducer,
                loanwords_transducer, sw_pre_transducer, add_meta_arc,
-               with_syllabification):
+               with_syllabification, recipient_transducers=None,
+               specialized_loanwords=None):
   sample = TrainingSample(sw_w, sw_pron_list, ar_correct_words)
   time_a = time.time()
   if os.path.isfile(ar_words_to_sample_filename):
@@ -263,29 +633,46 @@ def MakeSample(sample_file_prefix, ar_words_to_sample_filename, sw_w, sw_pron_li
         if len(line):
           reachable_ar_words.append(tuple(line.split()))
     #print("Using reachable only AR vocab:", reachable_ar_words)
-    ar_vocab = pt.UnionLinearChains(reachable_ar_words)
-    print("  minimizing")
-    ar_vocab = pt.Minimize(ar_vocab)
-    ar_vocab.arc_sort_output()
-    print("  compose with ar_post_transducer")
-    ar_vocab = ar_vocab >> ar_post_transducer
-    ar_vocab.arc_sort_output()
-    ar_vocab_groups = [ar_vocab]
+    if reachable_ar_words:
+      ar_vocab = pt.UnionLinearChains(reachable_ar_words)
+      print("  minimizing")
+      ar_vocab = pt.Minimize(ar_vocab)
+      ar_vocab.arc_sort_output()
+      print("  compose with ar_post_transducer")
+      ar_vocab = ar_vocab >> ar_post_transducer
+      ar_vocab.arc_sort_output()
+      ar_vocab_groups = [vocab_groups.VocabGroup(ar_vocab)]
+    else:
+      print("  NOT reachable in the reachability index")
+      ar_vocab_groups = []
     save_reachability = False
   else:
     save_reachability = True
   time_b = time.time()
   print("     ar_vocab took:", time_b-time_a, "sec")
+  if args.prune_at_best_correct:
+    # Only the best path is built, so neither the sample nor the reachability
+    # index are saved.
+    sample.DecodeAt1(ar_vocab_groups, ar_post_transducer, loanwords_transducer,
+                     sw_pre_transducer, with_syllabification=with_syllabification,
+                     recipient_transducers=recipient_transducers,
+                     specialized_loanwords=specialized_loanwords)
+    SaveCorrectReachable(ar_words_to_sample_filename, len(sample.t_correct) > 0)
+    return sample
   if not sample.Read(sample_file_prefix):
     time_c = time.time()
     print("  ApplyLoanwords")
     sample.ApplyLoanwords(ar_vocab_groups, loanwords_transducer,
                           sw_pre_transducer, add_meta_arc=add_meta_arc,
-                          with_syllabification=with_syllabification)
+                          with_syllabification=with_syllabification,
+                          recipient_transducers=recipient_transducers,
+                          specialized_loanwords=specialized_loanwords)
     time_d = time.time()
     print("     loanwords took:", time_d-time_c, "sec")
-    print("  write transducers")
-    sample.Write(sample_file_prefix)
+    if not args.only_reachability_index:
+      print("  write transducers")
+      sample.Write(sample_file_prefix)
+  print("    t_all size:", len(sample.t_all), "states", sample.t_all.num_arcs(), "arcs")
   if len(sample.t_all) == 0:
     print("    NOT reachable from ANY AR word")
   elif len(sample.t_correct) == 0:
@@ -313,16 +700,63 @@ def MakeSample(sample_file_prefix, ar_words_to_sample_filename, sw_w, sw_pron_li
     print("    saving reachability took:", time_f - time_e, "sec")
   time_g = time.time()
   print("    total MakeSample time:", time_g - time_a, "sec", sample_file_prefix)
+  if hasattr(ar_vocab_groups, "CacheStats"):
+    print("    AR vocab groups:", ar_vocab_groups.CacheStats())
   return sample
 
+def CorrectReachable(sample_filename, ar_words_to_sample_filename, sw_w, sw_pron_list,
+                     ar_correct_words, ar_post_transducer, loanwords_transducer,
+                     sw_pre_transducer, add_meta_arc, with_syllabification,
+                     recipient_transducers=None, specialized_loanwords=None):
+  """Returns True if the SW word is reachable from any of its correct AR
+     words. Uses the reachability index if it exists, otherwise composes
+     only the correct words and caches the result next to the index."""
+  if os.path.isfile(ar_words_to_sample_filename):
+    with open(ar_words_to_sample_filename) as f:
+      reachable_ar_words = set(tuple(line.split()) for line in f if line.strip())
+    return len(reachable_ar_words & set(ar_correct_words)) > 0
+  cache_filename = ar_words_to_sample_filename + ".correct_reachable"
+  if os.path.isfile(cache_filename):
+    return open(cache_filename).read().strip() == "True"
+  if ar_correct_words:
+    ar_vocab = pt.UnionLinearChains(ar_correct_words)
+    ar_vocab.arc_sort_output()
+    ar_vocab = ar_vocab >> ar_post_transducer
+    ar_vocab.arc_sort_output()
+    sample = TrainingSample(sw_w, sw_pron_list, ar_correct_words)
+    sample.ApplyLoanwords([vocab_groups.VocabGroup(ar_vocab)], loanwords_transducer,
+                          sw_pre_transducer, add_meta_arc=add_meta_arc,
+                          with_syllabification=with_syllabification,
+                          recipient_transducers=recipient_transducers,
+                          specialized_loanwords=specialized_loanwords)
+    reachable = len(sample.t_correct) > 0
+  else:
+    reachable = False
+  SaveCorrectReachable(ar_words_to_sample_filename, reachable)
+  return reachable
+
+def SaveCorrectReachable(ar_words_to_sample_filename, reachable):
+  cache_filename = ar_words_to_sample_filename + ".correct_reachable"
+  if os.path.isfile(cache_filename):
+    return
+  with open(cache_filename + ".tmp", "w") as f:
+    f.write("{}\n".format(reachable))
+  os.rename(cache_filename + ".tmp", cache_filename)
+
 def LoadSamples(filename, sw_pron_dict, ar_pron_dict, ar_vocab_groups, ar_post_transducer,
                 loanwords_transducer, sw_pre_transducer,
                 transducers_dir, ar_words_to_sample_dir, add_meta_arc=True,
-                with_syllabification=False, start_line=0, worker_id=0, num_workers=1):
+                with_syllabification=False, start_line=0, worker_id=0, num_workers=1,
+                recipient_transducers=None, specialized_loanwords=None, test_lines=None):
+  num_used_lines = 0
   for i, line in enumerate(open(filename)):
     if i < start_line:
       continue
-    if i % num_workers != worker_id:
+    if test_lines is not None and i not in test_lines:
+      continue
+    # Shards by the used lines, so a subset of the lines is split evenly.
+    num_used_lines += 1
+    if (num_used_lines - 1) % num_workers != worker_id:
       continue
     tokens = line.strip().split(" ||| ")
     if len(tokens) > 1:
@@ -351,14 +785,31 @@ def LoadSamples(filename, sw_pron_dict, ar_pron_dict, ar_vocab_groups, ar_post_t
       if args.only_initialize_transducers:
         if os.path.isfile(sample_file_prefix+"t_all.tr") and os.path.isfile(sample_file_prefix+"t_correct.tr"):
           continue
+      if args.only_reachability_index and os.path.isfile(ar_words_to_sample_filename):
+        continue
+      if args.skip_unreachable_correct and not CorrectReachable(
+          sample_filename, ar_words_to_sample_filename, sw_w, sw_pron_list, ar_words,
+          ar_post_transducer, loanwords_transducer, sw_pre_transducer,
+          add_meta_arc=add_meta_arc, with_syllabification=with_syllabification,
+          recipient_transducers=recipient_transducers,
+          specialized_loanwords=specialized_loanwords):
+        print("Skipping. Not reachable from CORRECT AR words")
+        continue
 
       sample = MakeSample(sample_file_prefix, ar_words_to_sample_filename,
                           sw_w, sw_pron_list, ar_words, ar_vocab_groups,
                           ar_post_transducer, loanwords_transducer,
                           sw_pre_transducer, add_meta_arc=add_meta_arc,
-                          with_syllabification=with_syllabification)
+                          with_syllabification=with_syllabification,
+                          recipient_transducers=recipient_transducers,
+                          specialized_loanwords=specialized_loanwords)
       yield (sample, sample_filename)
 
+def ReadLineNumbers(filename):
+  if not filename:
+    return None
+  return set(int(line) for line in open(filename) if line.strip())
+
 def LoadPronDict(filename):
   result = collections.defaultdict(set)
   for line_num, line in enumerate(open(filename)):
@@ -376,37 +827,67 @@ def LoadPronDict(filename):
     result[word].add(pron)
   return result
 
-def InitSymbols(initialize_syms=True, add_meta_arc=True):
+def RuleNames():
+  """Names of all constraints and rules that the transducers can use."""
+  return set(operations.RULE_NAMES + ot_constraints.RULE_NAMES +
+             morphology.RULE_NAMES + syllabification.RULE_NAMES)
+
+def InitSymbols():
   # Load OT Constraint weights from files (or use default_weight)
   ot_constraint_weights = LoadWeightsFromFile(args.in_ot_constraint_weights)
+  for rule_name in RuleNames():
+    # Adds the default weight of the rules missing from the file.
+    ot_constraint_weights[rule_name]
   # Set the weights in abc and initalize ALL_SYMS and PASS_THROUGH.
   pt.abc.SetWeights(ot_constraint_weights)
 
-  # Initialize all transducers to populate the Symbol Table with all possible
-  # symbols.
-  if initialize_syms:
-    #print("1", list(pt.syms.items()))
-    unused_composed = ComposeAllTransducers(add_meta_arc=add_meta_arc, only_init=True)
-    #print("2", list(pt.syms.items()))
-    morphology.ar_morphology_transducer(add_meta_arc=add_meta_arc)
-    #print("3", list(pt.syms.items()))
-    morphology.sw_morphology_transducer(add_meta_arc=add_meta_arc)
-    #print("4", list(pt.syms.items()))
-    operations.vowel_deletion_transducer(add_meta_arc=add_meta_arc)
-    #print("5", list(pt.syms.items()))
+  # Derive the Symbol Table from the alphabet and the rule names, instead of
+  # building all transducers to populate it.
+  pt.syms = pt.StaticSymbolTable(pt.abc.ALL_SYMS | set([pt.abc.EDIT_MARKER]))
 
   # Update ALL_SYMS and PASS_THROUGH.
   pt.abc.ReInitSymbolTable(pt.syms)
 
-def Test(test_samples, test_out_dir, add_meta_arc=True):
+def WriteCandidates(sample, weighted, filename):
+  """Writes the violation counts of the num_candidates best paths of a
+     sample, one JSON object per line, after a header line."""
+  correct_ar_words = set("".join(w) for w in sample.ar_word_list)
+  candidates = {}
+  if len(weighted) > 0:
+    for path_istring, _, path_ot_constraints, _ in pt.GetPaths(weighted.shortest_path(args.num_candidates)):
+      violations = collections.Counter(path_ot_constraints)
+      ar_word = "".join(path_istring)
+      candidates[(ar_word, tuple(sorted(violations.items())))] = {
+          "ar_word": ar_word,
+          "correct": ar_word in correct_ar_words,
+          "violations": violations,
+      }
+  with open(filename + ".tmp", "w") as f:
+    f.write(json.dumps({"sw_word": sample.sw_word,
+                        "correct_reachable": len(sample.t_correct) > 0}) + "\n")
+    for _, candidate in sorted(candidates.items()):
+      f.write(json.dumps(candidate, sort_keys=True) + "\n")
+  os.rename(filename + ".tmp", filename)
+
+def Test(test_samples, test_out_dir, add_meta_arc=True, multi_decoder=None):
   print("Printing best paths")
   if add_meta_arc:
     weights_transducer = pt.weights_transducer()
   else:
     weights_transducer = None
+  num_samples = 0
+  total_states = 0
+  total_arcs = 0
   for sample, sample_filename in test_samples:
+    num_samples += 1
+    total_states += len(sample.t_all)
+    total_arcs += sample.t_all.num_arcs()
     print("testing the sample")
     time_a = time.time()
+    if multi_decoder is not None:
+      multi_decoder.Write(sample, sample_filename)
+      print("   multi decoding took:", time.time()-time_a, "sec", sample_filename)
+      continue
     test_out_file = open(os.path.join(test_out_dir, sample_filename), "w")
     if weights_transducer:
       print("  sample.t_all >> weights_transducer")
@@ -416,6 +897,8 @@ def Test(test_samples, test_out_dir, add_meta_arc=True):
       weighted = pt.Minimize(sample.t_all)
     else:
       weighted = sample.t_all
+    if args.candidates_dir:
+      WriteCandidates(sample, weighted, os.path.join(args.candidates_dir, sample_filename))
     print("  weighted.shortest_path(args.num_predicted_best_paths)")
     weighted = weighted.shortest_path(args.num_predicted_best_paths)
     ar_words = []
@@ -447,9 +930,11 @@ def Test(test_samples, test_out_dir, add_meta_arc=True):
     time_c = time.time()
     print("   writing output took:", time_c-time_b, "sec")
     print("   total sample writing time:", time_c-time_a, "sec", sample_filename)
+  print("Total t_all size over {} samples: {} states {} arcs".format(num_samples, total_states, total_arcs))
 
 def AssertReachable(ar_str, sw_str, ar_post_transducer, loanwords_transducer,
-                    sw_pre_transducer, add_meta_arc=True, with_syllabification=False):
+                    sw_pre_transducer, add_meta_arc=True, with_syllabification=False,
+                    recipient_transducers=None):
   print("Constructing input transducer for word:", ar_str)
   in_t = pt.linear_chain(ar_str)
   in_t = in_t >> ar_post_transducer
@@ -461,6 +946,8 @@ def AssertReachable(ar_str, sw_str, ar_post_transducer, loanwords_transducer,
   if with_syllabification:
     pt.AddSyllabificationArcs(out_t)
   out_t = sw_pre_transducer >> out_t
+  if recipient_transducers:
+    out_t = pt.ComposeRightToLeft(recipient_transducers, out_t)
   if add_meta_arc:
     out_t = out_t >> pt.weights_transducer()
 
@@ -493,76 +980,98 @@ def LoadTransducerFromFile(filename):
   else:
     return None
 
-def main():
+def LoadPronDicts():
+  print("Loading AR pronunciation_dict")
+  ar_pron_dict = LoadPronDict(args.ar_pronunciation_dict)
+  print("Loading SW pronunciation_dict")
+  sw_pron_dict = LoadPronDict(args.sw_pronunciation_dict)
+  print("Loaded pronunciation dicts")
+  return ar_pron_dict, sw_pron_dict
+
+def main(pron_dicts=None):
+  """Runs with the parsed args. pron_dicts are (ar_pron_dict, sw_pron_dict),
+     if they are already loaded. Returns the DirNames of the run."""
   add_meta_arc = not args.remove_meta_arcs
   with_syllabification = args.with_syllabification
 
   assert args.worker_id < args.num_workers, (args.worker_id, args.num_workers)
+  assert not (args.prune_at_best_correct and add_meta_arc), "--prune_at_best_correct needs weights"
+  assert not args.prune_at_best_correct or args.num_predicted_best_paths == 1
+  assert not (args.candidates_dir and not add_meta_arc), "--candidates_dir needs meta arcs"
+  assert not (args.decode_weights_files and not add_meta_arc), "--decode_weights_files needs meta arcs"
+  # MultiDecoder finds one best path per weights file and writes nothing else.
+  assert not (args.decode_weights_files and args.num_predicted_best_paths > 1), "--decode_weights_files decodes only the best path"
+  assert not (args.decode_weights_files and args.candidates_dir), "--candidates_dir is not written with --decode_weights_files"
+  assert not (args.only_reachability_index and add_meta_arc), "--only_reachability_index needs weights"
+  assert not (args.only_reachability_index and args.prune_at_best_correct)
+  if args.candidates_dir:
+    os.makedirs(args.candidates_dir, exist_ok=True)
 
   print("Initializing")
   os.makedirs("weights", exist_ok=True)
   cached_data_dir = 'cached_data'
-  syms_file = os.path.join(cached_data_dir, "syms_with_meta_" + str(add_meta_arc).lower())
-  if os.path.isfile(syms_file):
-    pt.syms = pt.fst._fst.read_symbols(syms_file)
-    write_syms = False
-  else:
-    write_syms = True
-
-  InitSymbols(initialize_syms=write_syms, add_meta_arc=add_meta_arc)
+  InitSymbols()
 
   dirnames = DirNames(base_dir=cached_data_dir, ar_pron_dict_file_name=args.ar_pronunciation_dict,
                       test_file_name=args.test_file,
                       add_meta_arc=add_meta_arc,
-                      with_syllabification=with_syllabification)
+                      with_syllabification=with_syllabification,
+                      constraints_on_sw_vocab=args.constraints_on_sw_vocab,
+                      max_edits=args.max_edits,
+                      max_cascade_edits=args.max_cascade_edits)
 
   print("Cache paths:")
   for k, v in sorted(dirnames.paths.items()):
     print("{}\t{}".format(k, v))
 
+  if pron_dicts is None:
+    pron_dicts = LoadPronDicts()
+  ar_pron_dict, sw_pron_dict = pron_dicts
+
   print("Composing all operations and constraints.")
-  
-  loanwords_transducer = LoadTransducerFromFile(dirnames.paths['loanwords_tr'])
-  if not loanwords_transducer:
-    loanwords_transducer = ComposeAllTransducers(add_meta_arc=add_meta_arc, with_syllabification=with_syllabification)
-    loanwords_transducer.write(dirnames.paths['loanwords_tr'], True, True)
+  if args.worker_id < 0 and not add_meta_arc:
+    # Pre-initialization (run_parallel_loanwords.sh --worker_id=-1, with or
+    # without --test_file) also builds the AR vocab groups, with all init
+    # jobs, so the workers only load them.
+    init_artifacts = InitArtifacts(dirnames, add_meta_arc, with_syllabification, ar_pron_dict)
+  else:
+    init_artifacts = InitArtifacts(dirnames, add_meta_arc, with_syllabification)
+  artifacts.BuildArtifacts(init_artifacts, num_jobs=args.init_jobs)
+  init_files = {a.name: a.Filename() for a in init_artifacts}
+  print("Cached transducers:")
+  for k, v in sorted(init_files.items()):
+    print("{}\t{}".format(k, v))
 
+  def LoadConstraintsTransducer():
+    if not args.precompose_constraints:
+      return None
+    return LoadTransducerFromFile(init_files['constraints'])
+
+  loanwords_transducer = LoadTransducerFromFile(init_files['loanwords'])
   print("Size of loanwords transducer:", len(loanwords_transducer))
 
+  specialized_loanwords = None
+  if args.specialize_output_alphabet:
+    specialized_loanwords = SpecializedTransducers(loanwords_transducer,
+                                                   args.specialization_cache_mb * 2**20)
+
+  recipient_transducers = None
+  if args.constraints_on_sw_vocab:
+    print("Building recipient side transducers")
+    constraints_transducer = LoadConstraintsTransducer()
+    recipient_transducers = RecipientTransducers(add_meta_arc=add_meta_arc,
+                                                 with_syllabification=with_syllabification,
+                                                 constraints_transducer=constraints_transducer)
+    for t in recipient_transducers:
+      if add_meta_arc and t is not constraints_transducer:
+        pt.AddPassThroughArcs(t)
+      t.arc_sort_output()
+
   if args.out_ot_constraint_weights:
     SaveWeightsToFile(pt.abc.OT_CONSTRAINTS, args.out_ot_constraint_weights)
 
-  print("Building AR morphology and vowel deletion")
-  ar_post_transducer = LoadTransducerFromFile(dirnames.paths['ar_post_tr'])
-  if not ar_post_transducer:
-    transducers = [
-        morphology.ar_morphology_transducer(add_meta_arc=add_meta_arc, with_syllabification=with_syllabification), 
-        operations.vowel_deletion_transducer(add_meta_arc=add_meta_arc),
-        operations.min_consonant_count_transducer(
-            min_consonant_count=args.min_consonant_count, add_meta_arc=add_meta_arc),
-    ]
-    ar_post_transducer = pt.Compose(transducers, add_meta_arc=add_meta_arc)
-    ar_post_transducer.arc_sort_input()
-    ar_post_transducer.write(dirnames.paths['ar_post_tr'], True, True) 
-
-  print("Building SW morphology transducer")
-  sw_pre_transducer = LoadTransducerFromFile(dirnames.paths['sw_pre_tr'])
-  if not sw_pre_transducer:
-    transducers = [
-        #pt.accept_all_transducer(), # Remove this one if adding more.
-        morphology.sw_morphology_transducer(add_meta_arc=add_meta_arc, with_syllabification=with_syllabification),
-
-    ]
-    sw_pre_transducer = pt.Compose(transducers, add_meta_arc=add_meta_arc)
-    sw_pre_transducer.arc_sort_output()
-    sw_pre_transducer.write(dirnames.paths['sw_pre_tr'], True, True)
-
-  print("Loading AR pronunciation_dict")
-  ar_pron_dict = LoadPronDict(args.ar_pronunciation_dict)
-  print("Loading SW pronunciation_dict")
-  sw_pron_dict = LoadPronDict(args.sw_pronunciation_dict)
-  
-  print("Loaded pronunciation dicts")
+  ar_post_transducer = LoadTransducerFromFile(init_files['ar_post'])
+  sw_pre_transducer = LoadTransducerFromFile(init_files['sw_pre'])
 
   # Load Arabic vocabulary
   class LazyArVocabGroups(object):
@@ -579,46 +1088,35 @@ def main():
         self.val = self.RealInit()
       return iter(self.val)
 
+    def __len__(self):
+      if self.val is None:
+        self.val = self.RealInit()
+      return len(self.val)
+
+    def CacheStats(self):
+      if isinstance(self.val, vocab_groups.VocabGroupProvider):
+        return self.val.CacheStats()
+      return "not loaded"
+
     def RealInit(self):
       print("Loading AR vocab")
       if add_meta_arc:
-        ar_vocab_groups = []
-      else:
-        ar_vocab_groups, ar_vocab_groups_minimized = LoadVocabFromFile(
-            pron_dict=ar_pron_dict, limit=None,
-            transducer_file_pattern=dirnames.paths['ar_vocab_dir'] + "/ar_vocab_group_*.tr")
-        if not ar_vocab_groups_minimized:
-          print("Minimize AR vocab groups. Total group num:", len(ar_vocab_groups))
-          for i in range(len(ar_vocab_groups)):
-            print(".", sep="", end="")
-            sys.stdout.flush()
-            ar_vocab = ar_vocab_groups[i]
-            ar_vocab = pt.Minimize(ar_vocab)
-            ar_vocab_groups[i] = ar_vocab
-            ar_vocab.write("{}/ar_vocab_group_{}.tr".format(dirnames.paths['ar_vocab_dir'], i), True, True)
-          print()
-        print("Applying ar_post_tranducer. Total group num:", len(ar_vocab_groups))
-        for i in range(len(ar_vocab_groups)):
-          print(".", sep="", end="")
-          sys.stdout.flush()
-          ar_vocab = ar_vocab_groups[i]
-          ar_vocab.arc_sort_output()
-          ar_vocab = ar_vocab >> ar_post_transducer
-          ar_vocab.arc_sort_output()
-          ar_vocab_groups[i] = ar_vocab
-        print()
+        return []
+      vocab_artifacts = InitArtifacts(dirnames, add_meta_arc, with_syllabification, ar_pron_dict)
+      artifacts.BuildArtifacts(vocab_artifacts, num_jobs=args.init_jobs)
+      filename = vocab_artifacts[-1].Filename()
+      if filename not in _loaded_ar_vocab_groups:
+        _loaded_ar_vocab_groups.clear()
+        _loaded_ar_vocab_groups[filename] = LoadArPostVocabGroups(
+            filename, max_bytes=args.vocab_cache_mb * 2**20)
+      ar_vocab_groups = _loaded_ar_vocab_groups[filename]
+      print("Loaded ar_post composed AR vocab groups. Total group num:", len(ar_vocab_groups))
       return ar_vocab_groups
 
   ar_vocab_groups = LazyArVocabGroups()
 
-  if write_syms:
-    pt.syms.write(syms_file)
-
   if args.worker_id < 0:
-    if not args.test_file:
-      # Quick Init mode.
-      ar_vocab_groups.RealInit()
-    return
+    return dirnames
 
   if args.test_file:
     print("Running testing")
@@ -629,12 +1127,26 @@ def main():
         dirnames.paths['reachable_test_dir'], add_meta_arc=add_meta_arc,
         with_syllabification=with_syllabification,
         start_line=args.start_line, worker_id=args.worker_id,
-        num_workers=args.num_workers)
-    if not args.only_initialize_transducers:
-      Test(test_samples_iter, dirnames.paths['test_out_dir'], add_meta_arc=add_meta_arc)
+        num_workers=args.num_workers,
+        recipient_transducers=recipient_transducers,
+        specialized_loanwords=specialized_loanwords,
+        test_lines=ReadLineNumbers(args.test_lines_file))
+    multi_decoder = None
+    if args.decode_weights_files:
+      test_out_dirs = [dirnames.paths['test_out_dir'] + "_" + dirnames.FileHash(f)
+                       for f in args.decode_weights_files]
+      for f, test_out_dir in zip(args.decode_weights_files, test_out_dirs):
+        print("multi_test_out_dir\t{}\t{}".format(f, test_out_dir))
+      multi_decoder = multi_decode.MultiDecoder(
+          [LoadWeightsFromFile(f) for f in args.decode_weights_files], test_out_dirs)
+    if not (args.only_initialize_transducers or args.only_reachability_index):
+      Test(test_samples_iter, dirnames.paths['test_out_dir'], add_meta_arc=add_meta_arc,
+           multi_decoder=multi_decoder)
     else:
       for sample in test_samples_iter:
         del sample
+  return dirnames
 
 if __name__ == '__main__':
+  ParseArgs()
   main()
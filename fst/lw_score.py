@@ -4,6 +4,7 @@
 
 """
 ./lw_score.py --dev_file ../data/train.sw-en-ar --weights_file_hash <md5_hash>
+./lw_score.py --dev_file ../data/train.sw-en-ar --sweep ../data/constraints/
 """
 import subprocess
 import argparse
@@ -11,17 +12,24 @@ import hashlib
 import os
 import shutil
 import json
+import eval as lw_eval
 from operator import itemgetter
 
 parser = argparse.ArgumentParser()
-parser.add_argument("--weights_file_hash", required=True)
-parser.add_argument("--parallel_exec_command", default="./run_parallel_loanwords.sh --remove_meta_arcs")
+weights_group = parser.add_mutually_exclusive_group(required=True)
+weights_group.add_argument("--weights_file_hash")
+weights_group.add_argument("--sweep", nargs="+",
+                           help="Weights files or directories of weights files to score and rank, "
+                                "instead of --weights_file_hash.")
+parser.add_argument("--sweep_exec_command", default="./run_parallel_loanwords.sh --skip_unreachable_correct",
+                    help="Builds the meta arc lattices once and decodes them with all the swept weights.")
+parser.add_argument("--parallel_exec_command", default="./run_parallel_loanwords.sh --remove_meta_arcs --skip_unreachable_correct")
 parser.add_argument("--eval_command", default="./eval.py --accuracy_at_n 1")
 parser.add_argument("--dev_file", default="../data/train.sw-en-ar")
 parser.add_argument("--log_dir", default="logs")
 parser.add_argument("--weights_dir", default="weights")
 # Only when running a multi-threaded config.
-parser.add_argument("--exec_command", default="./loanwords.py --remove_meta_arcs")
+parser.add_argument("--exec_command", default="./loanwords.py --remove_meta_arcs --skip_unreachable_correct")
 args = parser.parse_args()
 
 def ObjFunc(test_out_dir, reachable_test_dir, weights_file_hash):
@@ -51,12 +59,13 @@ def ObjFunc(test_out_dir, reachable_test_dir, weights_file_hash):
   output = open(stdout_filename).readlines()[-1]
   return -float(output.strip())
 
-def RunLoanwords(weights_file_hash, quick_init=False):
+def RunLoanwords(weights_file_hash, quick_init=False, weights_filename=None,
+                 extra_flags=(), out_file_suffix=""):
   # run loanwords.py with with vals for constraint weights
   # ./loanwords.py --remove_meta_arcs
   #                --test_file args.dev_file
   #                --in_ot_constraint_weights WeightsFile(args.weights_dir, vals)
-  out_file_prefix = weights_file_hash
+  out_file_prefix = weights_file_hash + out_file_suffix
   if quick_init:
     out_file_prefix = out_file_prefix + "_quick_init"
   if quick_init:
@@ -65,8 +74,11 @@ def RunLoanwords(weights_file_hash, quick_init=False):
     loanwords_exec_command = args.parallel_exec_command.split()
     loanwords_exec_command.append("--test_file")
     loanwords_exec_command.append(args.dev_file)
+  loanwords_exec_command.extend(extra_flags)
   loanwords_exec_command.append("--in_ot_constraint_weights")
-  loanwords_exec_command.append(os.path.join(args.weights_dir, weights_file_hash))
+  if weights_filename is None:
+    weights_filename = os.path.join(args.weights_dir, weights_file_hash)
+  loanwords_exec_command.append(weights_filename)
   stdout_filename = os.path.join(args.log_dir, out_file_prefix + "_lw_stdout")
   stderr_filename = os.path.join(args.log_dir, out_file_prefix + "_lw_stderr")
 
@@ -103,9 +115,78 @@ def FindTestOutDir(stdout_filename):
     if test_out_dir and reachable_test_dir and transducers_dir:
       return test_out_dir, reachable_test_dir, transducers_dir
 
+def SweepFiles():
+  result = []
+  for path in args.sweep:
+    if os.path.isdir(path):
+      result.extend(os.path.join(path, f) for f in sorted(os.listdir(path))
+                    if os.path.isfile(os.path.join(path, f)))
+    else:
+      assert os.path.isfile(path), path
+      result.append(path)
+  return result
+
+def Sweep(weights_files):
+  """Scores all weights files against the same meta arc lattices, which
+     loanwords.py decodes with all the weights in one pass. Returns
+     [(objective, weights file)], best first."""
+  m = hashlib.md5()
+  for filename in weights_files:
+    m.update(open(filename, "rb").read())
+  sweep_hash = m.hexdigest()
+  # The meta arc lattices are built only from the AR words in the
+  # reachability index of the dev file. It does not depend on the weights,
+  # so a run without meta arcs builds just the index with the first weights
+  # (and skips the lines that are already indexed), without decoding.
+  first_hash = hashlib.md5(open(weights_files[0], "rb").read()).hexdigest()
+  stdout_filename = RunLoanwords(first_hash, weights_filename=weights_files[0],
+                                 extra_flags=["--only_reachability_index"],
+                                 out_file_suffix="_reachability")
+  _, reachable_test_dir, transducers_dir = FindTestOutDir(stdout_filename)
+  if os.path.isdir(transducers_dir):
+    shutil.rmtree(transducers_dir)
+
+  loanwords_exec_command = args.sweep_exec_command.split()
+  loanwords_exec_command += ["--test_file", args.dev_file, "--decode_weights_files"] + weights_files
+  stdout_filename = os.path.join(args.log_dir, "sweep_" + sweep_hash + "_lw_stdout")
+  stderr_filename = os.path.join(args.log_dir, "sweep_" + sweep_hash + "_lw_stderr")
+  with open(stdout_filename, "w") as stdout_file:
+    with open(stderr_filename, "w") as stderr_file:
+      print(" ".join(loanwords_exec_command))
+      print("Output is written to:", stdout_filename)
+      print("Output is written to:", stderr_filename)
+      exit_code = subprocess.call(loanwords_exec_command, stdout=stdout_file, stderr=stderr_file)
+      if exit_code != 0:
+        print("Error running loanwords.py")
+        raise subprocess.CalledProcessError(exit_code, " ".join(loanwords_exec_command))
+  test_out_dirs = {}
+  for line in open(stdout_filename):
+    if line.startswith('multi_test_out_dir\t'):
+      _, filename, test_out_dir = line.strip().split('\t')
+      test_out_dirs[filename] = test_out_dir
+
+  eval_args = lw_eval.parser.parse_args(args.eval_command.split()[1:])
+  ar_pron_dict = lw_eval.LoadPronDict(eval_args.ar_pronunciation_dict)
+  results = []
+  for filename in weights_files:
+    summary = lw_eval.Evaluate(ar_pron_dict, args.dev_file, test_out_dirs[filename],
+                               reachable_test_dir, eval_args.accuracy_at_n, eval_args.max_weight)
+    results.append((lw_eval.Objective(summary), filename))
+  results.sort(key=itemgetter(0), reverse=True)
+  with open(os.path.join(args.log_dir, "sweep_" + sweep_hash + ".tsv"), "w") as f:
+    for objective, filename in results:
+      f.write("{}\t{}\n".format(objective, filename))
+  return results
+
 def main():
-  assert os.path.isfile(os.path.join(args.weights_dir, args.weights_file_hash))
   os.makedirs(args.log_dir, exist_ok=True)  
+  if args.sweep:
+    results = Sweep(SweepFiles())
+    print("RANK\tOBJECTIVE\tWEIGHTS FILE")
+    for rank, (objective, filename) in enumerate(results):
+      print("{}\t{}\t{}".format(rank + 1, objective, filename))
+    return
+  assert os.path.isfile(os.path.join(args.weights_dir, args.weights_file_hash))
   print("COST:", Score(args.weights_file_hash))
 
 if __name__ == '__main__':
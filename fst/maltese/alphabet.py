@@ -4,7 +4,21 @@
 import fst
 import collections
 
+class Weights(collections.defaultdict):
+  """OT constraint weights that can record which weights were read."""
+  def __init__(self, weights):
+    super(Weights, self).__init__(getattr(weights, "default_factory", None), weights)
+    self.recorded = None
+
+  def __getitem__(self, key):
+    if self.recorded is not None:
+      self.recorded.add(key)
+    return super(Weights, self).__getitem__(key)
+
 class Alphabet(object):
+  # Fields that are not recorded as dependencies, weights are recorded by key.
+  NOT_RECORDED_FIELDS = set(["OT_CONSTRAINTS"])
+
   def __init__(self):
     # All regular alphabet chars.
     self.SEMIVOWELS = set("jwyɥʎ")
@@ -16,6 +30,9 @@ class Alphabet(object):
     self.EPSILON = fst.EPSILON
     self.CONSONANT_DOT = ".C."
     self.VOWEL_DOT = ".V."
+    # Emitted by the operations when a cascade-wide edit budget is used.
+    # Not part of ALL_SYMS, it is passed explicitly through the operations.
+    self.EDIT_MARKER = ".E."
 
     self.SYLLABLE_BOUNDARIES = set([self.CONSONANT_DOT, self.VOWEL_DOT])
     self.ALL_SYMS = self.ALL_LETTERS | self.SYLLABLE_BOUNDARIES  # This is updated in ReInitSymbolTable
@@ -171,6 +188,8 @@ class Alphabet(object):
     return category
 
   def SetWeights(self, ot_constraint_weights):
+    if ot_constraint_weights is not None:
+      ot_constraint_weights = Weights(ot_constraint_weights)
     self.OT_CONSTRAINTS = ot_constraint_weights
     self.ReInitSymbolTable()
 
@@ -184,9 +203,40 @@ class Alphabet(object):
           if s.startswith("<") and len(s) > 1:
             self.OT_CONSTRAINTS[s]
           else:
-            if s != fst.EPSILON and s not in self.ALL_SYMS:
+            if s != fst.EPSILON and s != self.EDIT_MARKER and s not in self.ALL_SYMS:
               unexpected_syms.add(s)
         assert len(unexpected_syms) == 0, unexpected_syms
       self.PASS_THROUGH_SYMS.update(list(self.OT_CONSTRAINTS.keys()))
     self.ALL_SYMS = self.ALL_LETTERS | self.SYLLABLE_BOUNDARIES | self.PASS_THROUGH_SYMS
 
+  def StartRecording(self):
+    """Records the fields and weights that are read until StopRecording."""
+    self.recorded_fields = set()
+    self.OT_CONSTRAINTS.recorded = set()
+    self.__class__ = RecordingAlphabet
+
+  def StopRecording(self):
+    """Returns the names of the fields and weights read since StartRecording."""
+    self.__class__ = Alphabet
+    manifest = {
+        "fields": sorted(self.recorded_fields - self.NOT_RECORDED_FIELDS),
+        "weights": sorted(self.OT_CONSTRAINTS.recorded),
+    }
+    self.recorded_fields = None
+    self.OT_CONSTRAINTS.recorded = None
+    return manifest
+
+  def RecordedValues(self, manifest):
+    """Returns the current values of the fields and weights in manifest."""
+    return {
+        "fields": [(f, getattr(self, f)) for f in manifest["fields"]],
+        "weights": [(w, self.OT_CONSTRAINTS[w]) for w in manifest["weights"]],
+    }
+
+class RecordingAlphabet(Alphabet):
+  """Alphabet while recording, the class is swapped so that reads are not
+     slowed down otherwise."""
+  def __getattribute__(self, name):
+    if name.isupper():
+      object.__getattribute__(self, "recorded_fields").add(name)
+    return object.__getattribute__(self, name)
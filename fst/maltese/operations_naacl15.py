@@ -3,7 +3,14 @@
 import phone_transducer as pt
 import itertools
 
-def phone_substitution_transducer(add_meta_arc=True):
+# Names of all the rules that the operations below can violate.
+RULE_NAMES = [
+    "<<IDENT-IO-manner>>", "<<IDENT-IO-place>>", "<<IDENT-IO-frontness>>",
+    "<<IDENT-IO-openness>>", "<<IDENT-IO-roundness>>", "<<IDENT-IO-v>>",
+    "<<IDENT-IO-c>>", "<<DEP-IO>>", "<<MAX-IO>>", "<<RO_MORPH>>", "<<MAX-V>>",
+]
+
+def phone_substitution_transducer(add_meta_arc=True, max_edits=None, edit_marker=False):
   """Substitute similar phones (optionally)."""
   def DetectViolation(l_ar, l_sw, group):
     if l_ar == pt.abc.EPSILON or l_sw == pt.abc.EPSILON:
@@ -13,7 +20,7 @@ def phone_substitution_transducer(add_meta_arc=True):
     return False
   
   max_node = 0
-  t = pt.Transducer()
+  t = pt.Rule()
   for l in pt.abc.ALL_SYMS:
     t.add_arc(0, 0, l, l)
   for s_ar, s_sw in pt.abc.AR_SW_SIMILAR_PHONES:
@@ -29,7 +36,7 @@ def phone_substitution_transducer(add_meta_arc=True):
     
     for l_ar, l_sw in itertools.zip_longest(s_ar, s_sw, fillvalue=pt.abc.EPSILON):
       max_node += 1
-      t.add_arc(prev_node, max_node, l_ar, l_sw) 
+      t.add_arc(prev_node, max_node, l_ar, l_sw, edit=(prev_node == 0))
       prev_node = max_node
       if not manner_violated:
         manner_violated = DetectViolation(l_ar, l_sw, pt.abc.MANNER_OF_ARTICULATION)
@@ -131,14 +138,14 @@ def phone_substitution_transducer(add_meta_arc=True):
 
     t.add_arc(max_node, 0, pt.abc.EPSILON, pt.abc.EPSILON)
 
-  t[0].final = True
-  return t
+  t.set_final(0)
+  return t.Build(max_edits, edit_marker)
 
 
-def epenthesis_transducer(add_meta_arc=True):
+def epenthesis_transducer(add_meta_arc=True, max_edits=None, edit_marker=False):
   """Inserts a vowel between two consonants (states 1 and 2) or at the end of
      the word after a consonant. Or just outputs the letters as-is."""
-  t = pt.Transducer()
+  t = pt.Rule()
   for l in pt.abc.ALL_SYMS:
     t.add_arc(0, 0, l, l)
   for l in pt.abc.CONSONANTS:
@@ -146,7 +153,7 @@ def epenthesis_transducer(add_meta_arc=True):
     t.add_arc(2, 0, l, l)
   next_node = 3
   for l in pt.abc.VOWELS:
-    t.add_arc(1, next_node, pt.abc.EPSILON, l)
+    t.add_arc(1, next_node, pt.abc.EPSILON, l, edit=True)
 
     rule_name = "<<DEP-IO>>"
     if add_meta_arc:
@@ -155,18 +162,18 @@ def epenthesis_transducer(add_meta_arc=True):
       t.add_arc(next_node, 2, pt.abc.EPSILON, pt.abc.EPSILON, pt.abc.OT_CONSTRAINTS[rule_name])
     next_node += 1
 
-  t[0].final = True
-  t[2].final = True
-  return t
+  t.set_final(0)
+  t.set_final(2)
+  return t.Build(max_edits, edit_marker)
 
-def degemination_transducer(add_meta_arc=True): 
+def degemination_transducer(add_meta_arc=True, max_edits=None, edit_marker=False):
   """Remove repeated consonants (optionally)."""
-  t = pt.Transducer()
+  t = pt.Rule()
   for l in pt.abc.ALL_SYMS:
     t.add_arc(0, 0, l, l)
   next_node = 1
   for l in pt.abc.CONSONANTS:
-    t.add_arc(0, next_node, l, l)
+    t.add_arc(0, next_node, l, l, edit=True)
 
     rule_name = "<<MAX-IO>>"
     if add_meta_arc:
@@ -175,12 +182,12 @@ def degemination_transducer(add_meta_arc=True):
       t.add_arc(next_node, 0, pt.abc.EPSILON, pt.abc.EPSILON, pt.abc.OT_CONSTRAINTS[rule_name])
     next_node += 1
 
-  t[0].final = True
-  return t
+  t.set_final(0)
+  return t.Build(max_edits, edit_marker)
 
 def final_vowel_substitution_transducer(add_meta_arc=True):
   """Substitute final vowels (optionally)."""
-  t = pt.Transducer()
+  t = pt.Rule()
   for l in pt.abc.ALL_SYMS:
     t.add_arc(0, 0, l, l)
     t.add_arc(0, 1, l, l)
@@ -207,17 +214,17 @@ def final_vowel_substitution_transducer(add_meta_arc=True):
   t.add_arc(1, 1, pt.abc.CONSONANT_DOT, pt.abc.CONSONANT_DOT)
   t.add_arc(1, 1, pt.abc.VOWEL_DOT, pt.abc.VOWEL_DOT)
 
-  t[1].final = True
-  return t
+  t.set_final(1)
+  return t.Build()
 
-def vowel_deletion_transducer(add_meta_arc=True):
+def vowel_deletion_transducer(add_meta_arc=True, max_edits=None):
   """Deletion of vowels."""
-  t = pt.Transducer()
+  t = pt.Rule()
   for l in pt.abc.ALL_SYMS:
     t.add_arc(0, 0, l, l)
   next_node = 1
   for l in pt.abc.VOWELS:
-    t.add_arc(0, next_node, l, pt.abc.EPSILON)
+    t.add_arc(0, next_node, l, pt.abc.EPSILON, edit=True)
 
     rule_name = "<<MAX-V>>"
     if add_meta_arc:
@@ -226,7 +233,8 @@ def vowel_deletion_transducer(add_meta_arc=True):
       t.add_arc(next_node, 0, pt.abc.EPSILON, pt.abc.EPSILON, pt.abc.OT_CONSTRAINTS[rule_name])
     next_node += 1
 
-  t[0].final = True
+  t.set_final(0)
+  t = t.Build(max_edits)
   if add_meta_arc:
     pt.AddPassThroughArcs(t)
   return t
@@ -246,3 +254,16 @@ def min_consonant_count_transducer(min_consonant_count=3, add_meta_arc=True):
     pt.AddPassThroughArcs(t)
   return t
 
+
+
+def edit_budget_transducer(max_edits, add_meta_arc=True):
+  """Removes the edit markers emitted by the operations and allows at most
+     |max_edits| of them on a path."""
+  t = pt.Transducer()
+  for i in range(max_edits+1):
+    for l in pt.abc.ALL_SYMS:
+      t.add_arc(i, i, l, l)
+    if i > 0:
+      t.add_arc(i-1, i, pt.abc.EDIT_MARKER, pt.abc.EPSILON)
+    t[i].final = True
+  return t
@@ -18,6 +18,9 @@ class Morphemes(object):
 
 morphemes = Morphemes()
 
+# Names of the rules used by the morphology transducers below.
+RULE_NAMES = ["<<IT_MORPH>>", "<<MT_MORPH>>"]
+
 def strip_transducer(morpheme_set, operation_weight, add_meta_arc, rule_name):
   """Transducer that removes strings. Used for AR suffixes and prefixes"""
   t = pt.Transducer()
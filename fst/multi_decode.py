@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Decodes the meta arc lattices of the samples (t_all) with many weight
+vectors in one pass.
+
+The cost of a path under a weight vector is the sum of its arc weights and
+of the weights of the constraints on its output labels, as in
+t_all >> weights_transducer(). A single dynamic programming sweep over the
+topologically sorted states carries a vector of costs per state, one per
+weight vector, and backpointers for each of them, so K weight vectors cost
+about as much as one shortest path."""
+
+import phone_transducer as pt
+import numpy as np
+import os
+
+class Lattice(object):
+  """The arcs of an acyclic transducer, with the states in topological
+  order."""
+  def __init__(self, t, constraint_index):
+    t = t.copy()
+    t.top_sort()
+    self.start = t.start
+    self.num_states = len(t)
+    self.final = np.array([float(t[s].final) for s in range(self.num_states)])
+    # Per state: next states, arc weights, constraint indices (-1 if the
+    # output is not a constraint) and the (input, output) symbols.
+    self.next_states = []
+    self.weights = []
+    self.constraints = []
+    self.labels = []
+    for s in range(self.num_states):
+      next_states, weights, constraints, labels = [], [], [], []
+      for arc in t[s].arcs:
+        assert arc.nextstate > s, "Not an acyclic transducer"
+        isymbol = t.isyms.find(arc.ilabel) if arc.ilabel != pt.fst.EPSILON_ID else pt.abc.EPSILON
+        osymbol = t.osyms.find(arc.olabel) if arc.olabel != pt.fst.EPSILON_ID else pt.abc.EPSILON
+        next_states.append(arc.nextstate)
+        weights.append(float(arc.weight))
+        constraints.append(constraint_index.get(osymbol, -1))
+        labels.append((isymbol, osymbol))
+      self.next_states.append(next_states)
+      self.weights.append(np.array(weights))
+      self.constraints.append(np.array(constraints, dtype=int))
+      self.labels.append(labels)
+
+  def Decode(self, W):
+    """W is a K x num_constraints matrix of weight vectors. Returns the best
+       path for each of them: (cost, [(isymbol, osymbol)]), or None if the
+       lattice has no path."""
+    K = len(W)
+    if self.num_states == 0:
+      return [None] * K
+    # The last column is the weight of arcs without a constraint.
+    W = np.hstack([W, np.zeros((K, 1))])
+    dist = np.full((self.num_states, K), np.inf)
+    dist[self.start] = 0.0
+    back_state = np.full((self.num_states, K), -1, dtype=int)
+    back_arc = np.full((self.num_states, K), -1, dtype=int)
+    for s in range(self.num_states):
+      if not self.next_states[s] or not np.isfinite(dist[s]).any():
+        continue
+      costs = dist[s][:, None] + self.weights[s][None, :] + W[:, self.constraints[s]]
+      for j, next_state in enumerate(self.next_states[s]):
+        better = costs[:, j] < dist[next_state]
+        if better.any():
+          dist[next_state][better] = costs[better, j]
+          back_state[next_state][better] = s
+          back_arc[next_state][better] = j
+    totals = dist + self.final[:, None]
+    best_states = np.argmin(totals, axis=0)
+    result = []
+    for k in range(K):
+      s = best_states[k]
+      cost = totals[s, k]
+      if not np.isfinite(cost):
+        result.append(None)
+        continue
+      path = []
+      while back_state[s, k] >= 0:
+        path.append(self.labels[back_state[s, k]][back_arc[s, k]])
+        s = back_state[s, k]
+      result.append((float(cost), path[::-1]))
+    return result
+
+def FormatPath(path):
+  """Returns the AR word, the constraints, the output string and the full
+     path of a path, as pt.GetPaths() reads them."""
+  ar_word, constraints, out_string, full_path = [], [], [], []
+  for isymbol, osymbol in path:
+    if isymbol in pt.abc.ALL_LETTERS:
+      ar_word.append(isymbol)
+    if osymbol in pt.abc.OT_CONSTRAINTS:
+      constraints.append(osymbol)
+    elif osymbol in pt.abc.SYLLABLE_BOUNDARIES:
+      osymbol = "."
+    elif osymbol != pt.abc.EPSILON:
+      out_string.append(osymbol)
+    if isymbol != pt.abc.EPSILON or osymbol != pt.abc.EPSILON:
+      full_path.append((isymbol, osymbol))
+  return "".join(ar_word), constraints, "".join(out_string), full_path
+
+class MultiDecoder(object):
+  """Writes the best path of every sample under each of several weight
+  vectors, in the test output format of loanwords.py, to one test_out_dir
+  per weight vector."""
+  def __init__(self, weight_dicts, test_out_dirs):
+    self.constraint_list = sorted(pt.abc.OT_CONSTRAINTS)
+    self.constraint_index = {c: i for i, c in enumerate(self.constraint_list)}
+    self.W = np.array([[weights[c] for c in self.constraint_list] for weights in weight_dicts])
+    self.test_out_dirs = test_out_dirs
+    for test_out_dir in test_out_dirs:
+      os.makedirs(test_out_dir, exist_ok=True)
+
+  def Write(self, sample, sample_filename):
+    lattice = Lattice(sample.t_all, self.constraint_index)
+    for test_out_dir, best in zip(self.test_out_dirs, lattice.Decode(self.W)):
+      if best is None:
+        ar_word, constraints, weight, out_string, full_path_string = "", "", "", "", ""
+      else:
+        cost, path = best
+        ar_word, path_constraints, out_string, full_path = FormatPath(path)
+        constraints = "#".join(path_constraints)
+        weight = str(cost)
+        full_path_string = str(full_path)
+      with open(os.path.join(test_out_dir, sample_filename), "w") as f:
+        f.write("{} ||| {} ||| {} ||| {} ||| {} ||| {}\n".format(
+            sample.sw_word, ar_word, constraints, weight, out_string, full_path_string))
@@ -3,16 +3,25 @@
 # Implements loanwords parameter optimization
 # objective function is accuracy on the dev set.
 # Algorithm: Nelder-Mead http://en.wikipedia.org/wiki/Nelder%E2%80%93Mead_method
+# or a population based optimizer from optimizers.py (--optimizer).
 
 """
 ./nm.py --dev_file ../data/train.en-mt-it --init_simplex ../data/constraints/uniform.txt |& tee nm.out
+./nm.py --dev_file ../data/train.en-mt-it --init_simplex ../data/constraints/uniform.txt \
+        --optimizer cma_es --target_accuracy 0.5 |& tee cma_es.out
 """
 import subprocess
+import objective
+import optimizers
 import numpy as np
 import argparse
 import hashlib
+import json
+import math
 import os
 import shutil
+import threading
+import time
 from operator import itemgetter
 from concurrent import futures
 
@@ -22,8 +31,8 @@ RO = -0.5
 SIGMA = 0.5
 
 parser = argparse.ArgumentParser()
-parser.add_argument("--exec_command", default="./loanwords.py --remove_meta_arcs")
-parser.add_argument("--parallel_exec_command", default="./run_parallel_loanwords.sh --remove_meta_arcs")
+parser.add_argument("--exec_command", default="./loanwords.py --remove_meta_arcs --skip_unreachable_correct")
+parser.add_argument("--parallel_exec_command", default="./run_parallel_loanwords.sh --remove_meta_arcs --skip_unreachable_correct")
 parser.add_argument("--eval_command", default="./eval.py --accuracy_at_n 1")
 parser.add_argument("--dev_file", default="../data/train.en-mt-it")
 parser.add_argument("--max_iterations", default=10000, type=int)
@@ -34,9 +43,37 @@ parser.add_argument("--eval_dir", default="eval_data")
 parser.add_argument("--obj_func", default="accuracy")
 parser.add_argument("--init_simplex", help="initial weights file")
 parser.add_argument("--simplex_radius", default=500.0, type=float)
+parser.add_argument("--use_subprocesses", default=False, action="store_true",
+                    help="Score with --parallel_exec_command and --eval_command subprocesses "
+                         "instead of a pool of warm workers.")
+parser.add_argument("--speculative", default=False, action="store_true",
+                    help="Score the reflection, expansion and contraction of a step concurrently.")
+parser.add_argument("--num_simplices", default=1, type=int,
+                    help="Number of independent simplices, the others start from random "
+                         "points within --simplex_radius of --init_simplex.")
+parser.add_argument("--optimizer", default="nelder_mead",
+                    choices=["nelder_mead"] + sorted(optimizers.OPTIMIZERS))
+parser.add_argument("--population_size", default=16, type=int,
+                    help="Weight vectors per generation of the population based optimizers.")
+parser.add_argument("--seed", default=0, type=int)
+parser.add_argument("--target_accuracy", type=float,
+                    help="Report the time and number of evaluations to reach this accuracy.")
+parser.add_argument("--fidelities", default="1.0",
+                    help="Comma separated fractions of the dev lines for successive halving of the "
+                         "generations of the population based optimizers, e.g. 0.1,0.3,1.0.")
+parser.add_argument("--halving_eta", default=3.0, type=float,
+                    help="Fraction (1/eta) of the candidates kept at each fidelity.")
+parser.add_argument("--no_resume", default=False, action="store_true",
+                    help="Start from --init_simplex even if --work_dir has a checkpoint of the simplex.")
+parser.add_argument("--num_workers", default=min(10, os.cpu_count()), type=int,
+                    help="Number of warm workers. They use the flags of --exec_command and --eval_command.")
 args = parser.parse_args()
 
 constraint_list = None  # Initialized in main
+scorer = None  # objective.Objective, initialized in main unless --use_subprocesses
+score_cache = None  # objective.ScoreCache, initialized in main
+trace = None  # Trace, initialized in main
+subsets = {}  # Fidelity -> file of dev line numbers, initialized in main
 
 def DictHash(d):
   m = hashlib.md5()
@@ -112,7 +149,124 @@ def RunLoanwords(vals, quick_init=False):
           raise subprocess.CalledProcessError(exit_code, " ".join(loanwords_exec_command)) 
   return stdout_filename, params_suffix
 
-def Score(vals, quick_init=False):
+def ScoreInProcess(vals, quick_init=False, fidelity=1.0):
+  weights = dict(zip(constraint_list, vals))
+  params_suffix = DictHash(weights)
+  print (params_suffix)
+  weights_filename = WeightsFile(
+      os.path.join(args.weights_dir, "constraint_weights_" + params_suffix), vals)
+  if quick_init:
+    scorer.Init(weights_filename, params_suffix + "_quick_init")
+    return
+  if fidelity < 1.0:
+    accuracy, paths = scorer.Score(weights_filename, "{}_{}".format(params_suffix, fidelity),
+                                   test_lines_file=subsets[fidelity])
+  else:
+    accuracy, paths = scorer.Score(weights_filename, params_suffix)
+  shutil.rmtree(paths['test_samples_dir'])
+  return 1.0 - accuracy
+
+class Trace(object):
+  """Logs the best score after every evaluation, with the elapsed time, to
+  compare the time to a target accuracy across optimizers. With resume, the
+  trace of the previous runs is continued: the elapsed time and the
+  evaluations are counted from its last line."""
+  def __init__(self, filename, resume=True):
+    self.filename = filename
+    self.start_time = time.time()
+    self.num_evaluations = 0
+    self.best_score = None
+    self.target_time = None
+    self.lock = threading.Lock()
+    if resume and os.path.isfile(self.filename):
+      with open(self.filename) as f:
+        content = f.read()
+      for line in content.splitlines()[1:]:
+        try:
+          elapsed, num_evaluations, _, best_score = line.split("\t")
+          elapsed, num_evaluations, best_score = float(elapsed), int(num_evaluations), float(best_score)
+        except ValueError:
+          # The last line of a crashed run may be cut.
+          continue
+        self.start_time = time.time() - elapsed
+        self.num_evaluations = num_evaluations
+        self.best_score = best_score
+      if content and not content.endswith("\n"):
+        with open(self.filename, "a") as f:
+          f.write("\n")
+      print("Resuming the trace after {} evaluations".format(self.num_evaluations))
+    else:
+      with open(self.filename, "w") as f:
+        f.write("elapsed_sec\tnum_evaluations\tscore\tbest_score\n")
+
+  def Add(self, score):
+    with self.lock:
+      elapsed = time.time() - self.start_time
+      self.num_evaluations += 1
+      if self.best_score is None or score < self.best_score:
+        self.best_score = score
+      with open(self.filename, "a") as f:
+        f.write("{:.1f}\t{}\t{}\t{}\n".format(elapsed, self.num_evaluations, score, self.best_score))
+      if (args.target_accuracy is not None and self.target_time is None and
+          args.obj_func == "accuracy" and 1.0 - self.best_score >= args.target_accuracy):
+        self.target_time = elapsed
+        print("Reached target accuracy {} after {:.1f} sec and {} evaluations".format(
+            args.target_accuracy, elapsed, self.num_evaluations))
+
+def Score(vals, quick_init=False, fidelity=1.0):
+  """Returns the score on the dev file, or on its subset of the fidelity."""
+  if quick_init:
+    return ComputeScore(vals, quick_init=True)
+  weights = dict(zip(constraint_list, vals))
+  if fidelity < 1.0:
+    # Keyed by the weights and the subset.
+    key = "{}_{}".format(DictHash(weights), os.path.basename(subsets[fidelity]))
+    return score_cache.Get(key, lambda: ScoreInProcess(vals, fidelity=fidelity),
+                           info=dict(weights=weights, fidelity=fidelity))
+  def ComputeAndTrace():
+    # Only evaluations are traced, not the scores read from the cache.
+    score = ComputeScore(vals)
+    trace.Add(score)
+    return score
+  return score_cache.Get(DictHash(weights), ComputeAndTrace, info=weights)
+
+def Fidelities():
+  fidelities = sorted(set(float(f) for f in args.fidelities.split(",")) | set([1.0]))
+  assert fidelities[0] > 0, args.fidelities
+  return fidelities
+
+def ScoreBatch(points):
+  """Scores the points concurrently, and returns their scores and their
+     order, best first. The warm workers queue their shards, so all points
+     are submitted at once.
+     With --fidelities, successive halving: all points are scored on the
+     smallest subset of the dev lines, and only the best 1/eta of them go on
+     to the next. The points that are dropped score infinity, so they never
+     become the best point, and are ordered after the points that went
+     further, by their score on the last subset they were scored on."""
+  max_workers = len(points) if scorer is not None else args.num_parallel_vertices
+  scores = [None] * len(points)
+  levels = [0] * len(points)
+  candidates = list(range(len(points)))
+  fidelities = Fidelities()
+  for level, fidelity in enumerate(fidelities):
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+      level_scores = list(executor.map(lambda i: Score(points[i], fidelity=fidelity), candidates))
+    for i, score in zip(candidates, level_scores):
+      scores[i] = score
+      levels[i] = level
+    if level + 1 < len(fidelities):
+      num_kept = max(1, int(math.ceil(len(candidates) / args.halving_eta)))
+      candidates = sorted(candidates, key=lambda i: scores[i])[:num_kept]
+      print("Fidelity {}: keeping {} candidates".format(fidelity, num_kept))
+  order = sorted(range(len(points)), key=lambda i: (-levels[i], scores[i]))
+  last_level = len(fidelities) - 1
+  return ([score if levels[i] == last_level else float('inf') for i, score in enumerate(scores)],
+          order)
+
+def ComputeScore(vals, quick_init=False):
+  if scorer is not None:
+    return ScoreInProcess(vals, quick_init=quick_init)
   stdout_filename, params_suffix = RunLoanwords(vals, quick_init=quick_init)
   if not quick_init:
     test_out_dir, reachable_test_dir, transducers_dir = FindTestOutDir(stdout_filename)
@@ -132,8 +286,18 @@ def FindTestOutDir(stdout_filename):
     if test_out_dir and reachable_test_dir and transducers_dir:
       return test_out_dir, reachable_test_dir, transducers_dir
 
+def ConfigHash():
+  """Hash of the flags that the scores depend on, besides the weights."""
+  return DictHash({"dev_file": args.dev_file, "exec_command": args.exec_command,
+                   "parallel_exec_command": args.parallel_exec_command,
+                   "eval_command": args.eval_command, "obj_func": args.obj_func})
+
 class Simplex(object):
-  def __init__(self, init_simplex):
+  def __init__(self, init_simplex, vertices=None):
+    if vertices is not None:
+      # Restored from a checkpoint.
+      self.vertices = vertices
+      return
     x0 = np.array(init_simplex)
     dim = len(init_simplex)
     vertices = [x0]
@@ -154,6 +318,14 @@ class Simplex(object):
     centroid = sum( (x for b,x in bestN) ) / len(bestN)
     return centroid
 
+  def Prefetch(self, centroid):
+    """Scores all points that the step from centroid may need at once. The
+       step then reads them from the score cache."""
+    worst = self.vertices[-1][1]
+    points = [centroid + coef * (centroid - worst) for coef in (ALPHA, GAMMA, RO)]
+    with futures.ThreadPoolExecutor(max_workers=len(points)) as executor:
+      list(executor.map(Score, points))
+
   def Reflection(self, centroid):
     reflection = centroid + ALPHA * (centroid - self.vertices[-1][1])
     accuracy = Score(reflection)
@@ -186,13 +358,45 @@ class Simplex(object):
       file_hash = DictHash(dict(zip(constraint_list, best_coord)))
       return "Best accuracy: {} at {} filename {}".format(best_accuracy, best_coord, file_hash)
 
-def NelderMead(init_simplex):
-  simplex = Simplex(init_simplex)
-  for i in range(args.max_iterations):
-    print("Iteration:", i)
+def SaveCheckpoint(filename, iteration, simplex):
+  checkpoint = {
+      "iteration": iteration,
+      "constraints": constraint_list,
+      "vertices": [(score, list(x)) for score, x in simplex.vertices],
+  }
+  with open(filename + ".tmp", "w") as f:
+    json.dump(checkpoint, f)
+  os.rename(filename + ".tmp", filename)
+
+def LoadCheckpoint(filename):
+  """Returns the next iteration and the simplex, or (0, None)."""
+  if args.no_resume or not os.path.isfile(filename):
+    return 0, None
+  checkpoint = json.load(open(filename))
+  if checkpoint["constraints"] != constraint_list:
+    print("Ignoring the checkpoint of other constraints:", filename)
+    return 0, None
+  vertices = [(score, np.array(x)) for score, x in checkpoint["vertices"]]
+  print("Resuming from iteration {} of {}".format(checkpoint["iteration"], filename))
+  return checkpoint["iteration"], Simplex(None, vertices=vertices)
+
+def NelderMead(init_simplex, simplex_id=0):
+  if simplex_id == 0:
+    checkpoint_name = "simplex_{}.json".format(ConfigHash())
+  else:
+    checkpoint_name = "simplex_{}_{}.json".format(ConfigHash(), simplex_id)
+  checkpoint_filename = os.path.join(args.work_dir, checkpoint_name)
+  start_iteration, simplex = LoadCheckpoint(checkpoint_filename)
+  if simplex is None:
+    simplex = Simplex(init_simplex)
+    SaveCheckpoint(checkpoint_filename, 0, simplex)
+  for i in range(start_iteration, args.max_iterations):
+    print("Simplex {} iteration: {}".format(simplex_id, i))
     simplex.Order()
     print(simplex)
     x0 = simplex.Centroid()
+    if args.speculative:
+      simplex.Prefetch(x0)
     r_accuracy, reflection = simplex.Reflection(x0)
     if r_accuracy < simplex.vertices[0][0]:
       print("Expansion")
@@ -212,6 +416,18 @@ def NelderMead(init_simplex):
       else:
         print("Reduction")
         simplex.Reduction()
+    SaveCheckpoint(checkpoint_filename, i + 1, simplex)
+  simplex.Order()
+  return simplex
+
+def RandomStarts(init_weights, num_starts):
+  """init_weights and num_starts - 1 random points around it."""
+  random_state = np.random.RandomState(0)
+  x0 = np.array(init_weights)
+  starts = [init_weights]
+  for _ in range(num_starts - 1):
+    starts.append(list(x0 + args.simplex_radius * random_state.uniform(-1, 1, len(x0))))
+  return starts
 
 def LoadWeightsFromFile(filename):
   result = {}
@@ -228,14 +444,50 @@ def LoadWeightsFromFile(filename):
     init_weights.append(v)
   return constraint_list, init_weights
 
+def RunOptimizer(init_weights):
+  optimizer = optimizers.OPTIMIZERS[args.optimizer](
+      ScoreBatch, init_weights, args.simplex_radius, args.population_size, seed=args.seed)
+  def Report(generation, best):
+    best_score, best_coord = best
+    file_hash = DictHash(dict(zip(constraint_list, best_coord)))
+    print("Generation: {} evaluations: {} elapsed: {:.1f} sec best score: {} filename {}".format(
+        generation, trace.num_evaluations, time.time() - trace.start_time, best_score, file_hash))
+  best_score, best_coord = optimizer.Run(args.max_iterations, callback=Report)
+  print("Best score: {} at {}".format(best_score, best_coord))
+
 def main():
   assert os.path.isfile(args.init_simplex)
-  global constraint_list
+  global constraint_list, scorer, score_cache, trace, subsets
   constraint_list, init_weights = LoadWeightsFromFile(args.init_simplex)
   os.makedirs(args.work_dir, exist_ok=True)
   os.makedirs(args.weights_dir, exist_ok=True)
   os.makedirs(args.eval_dir, exist_ok=True)
-  NelderMead(init_weights)
+  trace = Trace(os.path.join(args.work_dir, "trace_{}_{}.tsv".format(args.optimizer, ConfigHash())),
+                resume=not args.no_resume)
+  score_cache = objective.ScoreCache(
+      os.path.join(args.work_dir, "scores_{}.jsonl".format(ConfigHash())))
+  for fidelity in Fidelities()[:-1]:
+    assert not args.use_subprocesses, "--fidelities needs the warm workers"
+    subsets[fidelity] = objective.StratifiedSubset(args.dev_file, fidelity,
+                                                   os.path.join(args.work_dir, "subsets"))
+  if not args.use_subprocesses:
+    scorer = objective.Objective(args.exec_command.split()[1:], args.eval_command.split()[1:],
+                                 args.dev_file, args.num_workers, args.work_dir,
+                                 init_weights_filename=args.init_simplex)
+  try:
+    if args.optimizer != "nelder_mead":
+      RunOptimizer(init_weights)
+    elif args.num_simplices == 1:
+      NelderMead(init_weights)
+    else:
+      starts = RandomStarts(init_weights, args.num_simplices)
+      with futures.ThreadPoolExecutor(max_workers=args.num_simplices) as executor:
+        simplices = list(executor.map(NelderMead, starts, range(args.num_simplices)))
+      for simplex_id, simplex in enumerate(simplices):
+        print("Simplex {}: {}".format(simplex_id, simplex))
+  finally:
+    if scorer is not None:
+      scorer.Close()
 
 if __name__ == '__main__':
   main()
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Scores constraint weights on a dev file in process, for the optimizers.
+
+Instead of running run_parallel_loanwords.sh and eval.py for every weight
+vector, a pool of worker processes is forked once, after the pronunciation
+dicts are loaded and the cached transducers of the initial weights are
+built. The workers keep the dicts and the AR vocab groups they
+read between evaluations, so an evaluation only rebuilds the transducers
+that depend on the changed weights, decodes its share of the dev samples
+and returns. The objective of eval.py is computed by a worker too. The
+workers log to files; stdout of this process is redirected only before the
+workers start, as it is shared by the threads that score weight vectors
+concurrently.
+"""
+
+import loanwords
+import eval as lw_eval
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import threading
+
+class ScoreCache(object):
+  """Durable cache of the scores of weight vectors, in a JSON-lines file that
+  is appended after every evaluation. Concurrent requests for a key that is
+  being evaluated wait for that evaluation instead of starting another."""
+  def __init__(self, filename):
+    self.filename = filename
+    self.scores = {}
+    self.pending = {}
+    self.lock = threading.Lock()
+    self.num_hits = 0
+    if os.path.isfile(filename):
+      with open(filename) as f:
+        content = f.read()
+      for line in content.splitlines():
+        try:
+          entry = json.loads(line)
+        except ValueError:
+          # The last line of a crashed run may be cut.
+          continue
+        self.scores[entry["key"]] = entry["score"]
+      if content and not content.endswith("\n"):
+        with open(filename, "a") as f:
+          f.write("\n")
+      print("Loaded {} scores from {}".format(len(self.scores), filename))
+
+  def __contains__(self, key):
+    return key in self.scores
+
+  def Get(self, key, score_func, info=None):
+    """Returns the score of key, from the cache or from score_func()."""
+    with self.lock:
+      if key in self.scores:
+        self.num_hits += 1
+        return self.scores[key]
+      future = self.pending.get(key)
+      in_flight = future is not None
+      if not in_flight:
+        future = concurrent.futures.Future()
+        self.pending[key] = future
+    if in_flight:
+      return future.result()
+    try:
+      score = score_func()
+    except BaseException as e:
+      with self.lock:
+        del self.pending[key]
+      future.set_exception(e)
+      raise
+    with self.lock:
+      with open(self.filename, "a") as f:
+        f.write(json.dumps({"key": key, "score": score, "info": info}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+      self.scores[key] = score
+      del self.pending[key]
+    future.set_result(score)
+    return score
+
+def LineHash(line):
+  m = hashlib.md5()
+  m.update(line.encode("utf-8"))
+  return m.hexdigest()
+
+def StratifiedSubset(dev_file, fraction, out_dir):
+  """Writes the numbers of a fraction of the lines of dev_file, taken from
+  each stratum of the SW word length, and returns the filename. The lines
+  of a stratum are taken in the order of their MD5, so the subsets of
+  growing fractions are nested."""
+  strata = collections.defaultdict(list)
+  with open(dev_file) as f:
+    for i, line in enumerate(f):
+      tokens = line.strip().split(" ||| ")
+      sw = tokens[1] if len(tokens) > 1 else tokens[0]
+      strata[min(len(sw) // 4, 4)].append((LineHash(line), i))
+  lines = []
+  for stratum in strata.values():
+    stratum.sort()
+    lines.extend(i for _, i in stratum[:int(math.ceil(fraction * len(stratum)))])
+  m = hashlib.md5()
+  with open(dev_file, "rb") as f:
+    m.update(f.read())
+  filename = os.path.join(out_dir, "{}_{}".format(m.hexdigest(), fraction))
+  if not os.path.isfile(filename):
+    os.makedirs(out_dir, exist_ok=True)
+    with open(filename + ".tmp", "w") as f:
+      for i in sorted(lines):
+        f.write("{}\n".format(i))
+    os.rename(filename + ".tmp", filename)
+  return filename
+
+# Pronunciation dicts of loanwords.py and eval.py, loaded before the workers
+# are forked.
+_pron_dicts = None
+_eval_ar_pron_dict = None
+
+# The workers run one task at a time, so they can redirect their stdout.
+def _Decode(loanwords_args, log_filename):
+  loanwords.args = loanwords_args
+  with open(log_filename, "w") as log_file, contextlib.redirect_stdout(log_file):
+    return loanwords.main(_pron_dicts).paths
+
+def _Evaluate(eval_args, dev_file, paths, test_lines_file, log_filename):
+  with open(log_filename, "w") as log_file, contextlib.redirect_stdout(log_file):
+    summary = lw_eval.Evaluate(_eval_ar_pron_dict, dev_file,
+                               paths['test_out_dir'], paths['reachable_test_dir'],
+                               eval_args.accuracy_at_n, eval_args.max_weight,
+                               lw_eval.ReadLineNumbers(test_lines_file))
+    objective = lw_eval.Objective(summary)
+    print(objective)
+  return objective
+
+class Objective(object):
+  def __init__(self, loanwords_argv, eval_argv, dev_file, num_workers, log_dir,
+               init_weights_filename=None):
+    """loanwords_argv and eval_argv are the flags of loanwords.py and eval.py,
+       without the test file, weights and worker flags. With
+       init_weights_filename, the cached transducers of these weights are
+       built before the workers are forked (see PreInit)."""
+    global _pron_dicts, _eval_ar_pron_dict
+    self.loanwords_args = loanwords.ParseArgs(loanwords_argv)
+    self.eval_args = lw_eval.parser.parse_args(eval_argv)
+    self.dev_file = dev_file
+    self.num_workers = num_workers
+    self.log_dir = log_dir
+    os.makedirs(self.log_dir, exist_ok=True)
+    # The initializations write the same weight independent transducers, so
+    # they are done one at a time.
+    self.init_lock = threading.Lock()
+
+    print("Loading pronunciation dicts")
+    _pron_dicts = loanwords.LoadPronDicts()
+    _eval_ar_pron_dict = lw_eval.LoadPronDict(self.eval_args.ar_pronunciation_dict)
+    if init_weights_filename:
+      self.PreInit(init_weights_filename)
+    print("Starting {} warm workers".format(num_workers))
+    self.pool = multiprocessing.get_context("fork").Pool(num_workers)
+
+  def LoanwordsArgs(self, weights_filename, **kwargs):
+    result = copy.copy(self.loanwords_args)
+    result.in_ot_constraint_weights = weights_filename
+    for k, v in kwargs.items():
+      setattr(result, k, v)
+    return result
+
+  def PreInit(self, weights_filename):
+    """Builds the cached transducers of the weights and the AR vocab groups
+       in this process, with --init_jobs. The workers of the pool are
+       daemonic and cannot fork the init jobs, so this builds the artifacts
+       that do not depend on the weights (the AR vocab groups are the
+       largest) once, and the workers only build the rest."""
+    log_filename = os.path.join(self.log_dir, "pre_init")
+    print("Building the cached transducers, log:", log_filename)
+    init_args = self.LoanwordsArgs(weights_filename, test_file=None, worker_id=-1)
+    loanwords.args = init_args
+    with open(log_filename, "w") as log_file, contextlib.redirect_stdout(log_file):
+      loanwords.main(_pron_dicts)
+
+  def Init(self, weights_filename, name):
+    """Builds the cached transducers of the weights, as the quick init of
+       run_parallel_loanwords.sh does, in one job."""
+    log_filename = os.path.join(self.log_dir, name + "_init")
+    init_args = self.LoanwordsArgs(weights_filename, test_file=None, worker_id=-1,
+                                   init_jobs=1)
+    with self.init_lock:
+      self.pool.apply(_Decode, (init_args, log_filename))
+
+  def Decode(self, weights_filename, name, test_lines_file=None):
+    """Decodes the dev file, or its lines in test_lines_file, on all
+       workers. Returns the cache paths of loanwords.py."""
+    self.Init(weights_filename, name)
+    results = []
+    for worker_id in range(self.num_workers):
+      worker_args = self.LoanwordsArgs(weights_filename, test_file=self.dev_file,
+                                       worker_id=worker_id, num_workers=self.num_workers,
+                                       init_jobs=1, test_lines_file=test_lines_file)
+      log_filename = os.path.join(self.log_dir, "{}_{}".format(name, worker_id))
+      results.append(self.pool.apply_async(_Decode, (worker_args, log_filename)))
+    paths = [r.get() for r in results]
+    return paths[0]
+
+  def Score(self, weights_filename, name, test_lines_file=None):
+    """Returns the objective of eval.py (reachable correct soft accuracy) of
+       the weights, and the cache paths of loanwords.py. With test_lines_file
+       only its lines of the dev file are decoded and scored."""
+    paths = self.Decode(weights_filename, name, test_lines_file)
+    log_filename = os.path.join(self.log_dir, name + "_eval")
+    objective = self.pool.apply(_Evaluate, (self.eval_args, self.dev_file, paths,
+                                            test_lines_file, log_filename))
+    return objective, paths
+
+  def Close(self):
+    self.pool.close()
+    self.pool.join()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+# Population based optimizers of the constraint weights, for nm.py.
+# Each generation is scored as one batch, so all of its weight vectors are
+# decoded concurrently.
+# Differential evolution: http://en.wikipedia.org/wiki/Differential_evolution
+# CMA-ES: http://en.wikipedia.org/wiki/CMA-ES
+
+import numpy as np
+
+class Optimizer(object):
+  """Minimizes a score over weight vectors. score_batch(points) returns the
+  scores of a list of points and their order, best first. Points that were
+  not fully scored (e.g. dropped by successive halving) score infinity, and
+  only the order ranks them. Subclasses implement Ask() -> points of the
+  next generation, and Tell(points, scores, order)."""
+  def __init__(self, score_batch, x0, radius, population_size, seed=0):
+    self.score_batch = score_batch
+    self.x0 = np.array(x0, dtype=float)
+    self.dim = len(x0)
+    self.radius = radius
+    self.population_size = population_size
+    self.random_state = np.random.RandomState(seed)
+    self.best = None
+
+  def Clip(self, points):
+    # loanwords.py clamps the weights at 0, so all negative weights are the
+    # same point. Clipping them makes the score cache find it.
+    return [np.maximum(x, 0.0) for x in points]
+
+  def Ask(self):
+    raise NotImplementedError
+
+  def Tell(self, points, scores, order):
+    raise NotImplementedError
+
+  def Run(self, max_iterations, callback=None):
+    """Returns the best (score, point). callback(generation, best) is called
+       after every generation."""
+    for generation in range(max_iterations):
+      points = self.Ask()
+      scores, order = self.score_batch(points)
+      for score, x in zip(scores, points):
+        if np.isfinite(score) and (self.best is None or score < self.best[0]):
+          self.best = (score, x)
+      self.Tell(points, scores, order)
+      if callback is not None:
+        callback(generation, self.best)
+    return self.best
+
+class RandomSearch(Optimizer):
+  """Uniform samples in the box of radius around the best point so far."""
+  def Ask(self):
+    center = self.x0 if self.best is None else self.best[1]
+    return self.Clip([center + self.radius * self.random_state.uniform(-1, 1, self.dim)
+                      for _ in range(self.population_size)])
+
+  def Tell(self, points, scores, order):
+    pass
+
+class DifferentialEvolution(Optimizer):
+  """DE/rand/1/bin."""
+  F = 0.8
+  CR = 0.9
+
+  def __init__(self, *args, **kwargs):
+    super(DifferentialEvolution, self).__init__(*args, **kwargs)
+    assert self.population_size >= 4, "DE needs a population of at least 4"
+    self.population = None
+    self.scores = None
+
+  def Ask(self):
+    if self.population is None:
+      return self.Clip([self.x0] + [self.x0 + self.radius * self.random_state.uniform(-1, 1, self.dim)
+                                    for _ in range(self.population_size - 1)])
+    trials = []
+    for i, x in enumerate(self.population):
+      others = [j for j in range(self.population_size) if j != i]
+      a, b, c = self.random_state.choice(others, 3, replace=False)
+      mutant = self.population[a] + self.F * (self.population[b] - self.population[c])
+      crossover = self.random_state.uniform(size=self.dim) < self.CR
+      crossover[self.random_state.randint(self.dim)] = True
+      trials.append(np.where(crossover, mutant, x))
+    return self.Clip(trials)
+
+  def Tell(self, points, scores, order):
+    if self.population is None:
+      self.population = list(points)
+      self.scores = list(scores)
+      return
+    # A trial that was not fully scored (infinity) never replaces a parent
+    # that was.
+    for i, (x, score) in enumerate(zip(points, scores)):
+      if score <= self.scores[i]:
+        self.population[i] = x
+        self.scores[i] = score
+
+class CMAES(Optimizer):
+  """(mu/mu_w, lambda)-CMA-ES with rank-one and rank-mu updates of the
+  covariance, and cumulative step-size adaptation."""
+  def __init__(self, *args, **kwargs):
+    super(CMAES, self).__init__(*args, **kwargs)
+    n = self.dim
+    lam = self.population_size
+    self.mu = lam // 2
+    weights = np.log(self.mu + 0.5) - np.log(np.arange(1, self.mu + 1))
+    self.weights = weights / weights.sum()
+    self.mueff = 1.0 / np.sum(self.weights ** 2)
+    self.cc = (4 + self.mueff / n) / (n + 4 + 2 * self.mueff / n)
+    self.cs = (self.mueff + 2) / (n + self.mueff + 5)
+    self.c1 = 2 / ((n + 1.3) ** 2 + self.mueff)
+    self.cmu = min(1 - self.c1, 2 * (self.mueff - 2 + 1 / self.mueff) / ((n + 2) ** 2 + self.mueff))
+    self.damps = 1 + 2 * max(0, np.sqrt((self.mueff - 1) / (n + 1)) - 1) + self.cs
+    self.chi_n = np.sqrt(n) * (1 - 1.0 / (4 * n) + 1.0 / (21 * n ** 2))
+    self.mean = self.x0
+    self.sigma = self.radius
+    self.pc = np.zeros(n)
+    self.ps = np.zeros(n)
+    self.C = np.eye(n)
+    self.B = np.eye(n)
+    self.D = np.ones(n)
+    self.generation = 0
+
+  def Ask(self):
+    z = self.random_state.standard_normal((self.population_size, self.dim))
+    return self.Clip([self.mean + self.sigma * self.B.dot(self.D * z_i) for z_i in z])
+
+  def Tell(self, points, scores, order):
+    n = self.dim
+    order = np.array(order)
+    # The clipped points are the samples, so the update follows what was
+    # actually scored.
+    ys = (np.array(points)[order[:self.mu]] - self.mean) / self.sigma
+    y_w = self.weights.dot(ys)
+    self.mean = self.mean + self.sigma * y_w
+
+    c_invsqrt = self.B.dot(np.diag(1 / self.D)).dot(self.B.T)
+    self.ps = (1 - self.cs) * self.ps + np.sqrt(self.cs * (2 - self.cs) * self.mueff) * c_invsqrt.dot(y_w)
+    self.generation += 1
+    ps_norm = np.linalg.norm(self.ps)
+    hsig = (ps_norm / np.sqrt(1 - (1 - self.cs) ** (2 * self.generation)) / self.chi_n
+            < 1.4 + 2.0 / (n + 1))
+    self.pc = (1 - self.cc) * self.pc + hsig * np.sqrt(self.cc * (2 - self.cc) * self.mueff) * y_w
+    rank_mu = (ys.T * self.weights).dot(ys)
+    self.C = ((1 - self.c1 - self.cmu) * self.C +
+              self.c1 * (np.outer(self.pc, self.pc) + (1 - hsig) * self.cc * (2 - self.cc) * self.C) +
+              self.cmu * rank_mu)
+    self.sigma *= np.exp((self.cs / self.damps) * (ps_norm / self.chi_n - 1))
+
+    self.C = np.triu(self.C) + np.triu(self.C, 1).T
+    eigenvalues, self.B = np.linalg.eigh(self.C)
+    self.D = np.sqrt(np.maximum(eigenvalues, 1e-20))
+
+OPTIMIZERS = {
+    "random_search": RandomSearch,
+    "differential_evolution": DifferentialEvolution,
+    "cma_es": CMAES,
+}
@@ -9,9 +9,15 @@ un-syllabication
 
 Additional OT constraints are added in operations.py"""
 
+# Names of all the constraints below.
+RULE_NAMES = [
+    "<<NOCODA>>", "<<*COMPLEX-margin>>", "<<*COMPLEX>>", "<<PEAK>>",
+    "<<SSP>>", "<<*COMPLEX_VOW>>", "<<ONSET>>", "<<LEN>>",
+]
+
 def nocoda_transducer(add_meta_arc=True):
   """Syllables are open."""
-  t = pt.Transducer()
+  t = pt.Rule()
   for l in pt.abc.ALL_LETTERS:
     t.add_arc(0, 0, l, l)
 
@@ -30,12 +36,12 @@ def nocoda_transducer(add_meta_arc=True):
   t.add_arc(3, 0, pt.abc.CONSONANT_DOT, pt.abc.CONSONANT_DOT)
   t.add_arc(3, 0, pt.abc.VOWEL_DOT, pt.abc.VOWEL_DOT)
 
-  t[0].final = True
-  return t
+  t.set_final(0)
+  return t.Build()
 
 def no_complex_margin_transducer(add_meta_arc=True):
   """No consonants around syllable boundaries. E.g. 'c.b'"""
-  t = pt.Transducer()
+  t = pt.Rule()
   for l in pt.abc.VOWELS:
     t.add_arc(0, 0, l, l)
     t.add_arc(1, 0, l, l)
@@ -57,15 +63,15 @@ def no_complex_margin_transducer(add_meta_arc=True):
   else:
     t.add_arc(3, 1, pt.abc.EPSILON, pt.abc.EPSILON, pt.abc.OT_CONSTRAINTS[rule_name])
 
-  t[0].final = True
-  t[1].final = True
-  t[2].final = True
-  return t
+  t.set_final(0)
+  t.set_final(1)
+  t.set_final(2)
+  return t.Build()
 
 
 def no_complex_transducer(add_meta_arc=True):
   """No consonant clusters."""
-  t = pt.Transducer()
+  t = pt.Rule()
   for l in pt.abc.VOWELS:
     t.add_arc(0, 0, l, l)
     t.add_arc(1, 0, l, l)
@@ -84,14 +90,14 @@ def no_complex_transducer(add_meta_arc=True):
   else:
     t.add_arc(2, 1, pt.abc.EPSILON, pt.abc.EPSILON, pt.abc.OT_CONSTRAINTS[rule_name])
 
-  t[0].final = True
-  t[1].final = True
-  return t
+  t.set_final(0)
+  t.set_final(1)
+  return t.Build()
 
 
 def peak_transducer(add_meta_arc=True):
   """In a syllable sonority goes up then down (bell shaped)."""
-  t = pt.Transducer()
+  t = pt.Rule()
   # Exact Peak implementation is replaced by its approxiamtion: 
   # fire the Peak constraint if there is more than one vowel/semivowel/nasal in a sylable
 
@@ -117,15 +123,15 @@ def peak_transducer(add_meta_arc=True):
   else:
     t.add_arc(2, 1, pt.abc.EPSILON, pt.abc.EPSILON, pt.abc.OT_CONSTRAINTS[rule_name])
   
-  t[0].final = True
-  return t
+  t.set_final(0)
+  return t.Build()
 
 
   
 def ssp_transducer(add_meta_arc=True):
   """complex onsets rise in sonority toward the nucleus, 
      complex codas fall in sonority."""
-  t = pt.Transducer()
+  t = pt.Rule()
   """Simplified version for open syllables
   sonority_letters = set()
   for i, sonority_set in enumerate(pt.abc.SONORITY_LIST[:-2]):
@@ -176,13 +182,13 @@ def ssp_transducer(add_meta_arc=True):
     t.add_arc(max_state, 0, pt.abc.EPSILON, rule_name)
   else:
     t.add_arc(max_state, 0, pt.abc.EPSILON, pt.abc.EPSILON, pt.abc.OT_CONSTRAINTS[rule_name])
-  t[0].final = True
-  return t
+  t.set_final(0)
+  return t.Build()
   #"""
   
 def no_complex_vow_transducer(add_meta_arc=True):
   """No vowel clusters."""
-  t = pt.Transducer()
+  t = pt.Rule()
   for l in pt.abc.CONSONANTS:
     t.add_arc(0, 0, l, l)
     t.add_arc(1, 0, l, l)
@@ -201,13 +207,13 @@ def no_complex_vow_transducer(add_meta_arc=True):
     t.add_arc(0, 0, l, l)
     t.add_arc(1, 1, l, l)
 
-  t[0].final = True
-  t[1].final = True
-  return t
+  t.set_final(0)
+  t.set_final(1)
+  return t.Build()
 
 def onset_transducer(add_meta_arc=True):
   """Syllables start with a consonant."""
-  t = pt.Transducer()
+  t = pt.Rule()
   for l in pt.abc.CONSONANTS:
     t.add_arc(0, 1, l, l)
     t.add_arc(3, 1, l, l)
@@ -228,14 +234,14 @@ def onset_transducer(add_meta_arc=True):
   else:
     t.add_arc(2, 1, pt.abc.EPSILON, pt.abc.EPSILON, pt.abc.OT_CONSTRAINTS[rule_name])
 
-  t[1].final = True
-  t[3].final = True
-  return t
+  t.set_final(1)
+  t.set_final(3)
+  return t.Build()
 
 
 def length_transducer(add_meta_arc=True):
   """Syllables should have at most 3 letters."""
-  t = pt.Transducer()
+  t = pt.Rule()
   for l in pt.abc.ALL_LETTERS:
     t.add_arc(0, 1, l, l)
     t.add_arc(1, 2, l, l)
@@ -254,7 +260,20 @@ def length_transducer(add_meta_arc=True):
   else:
     t.add_arc(4, 3, pt.abc.EPSILON, pt.abc.EPSILON, pt.abc.OT_CONSTRAINTS[rule_name])
 
-  t[0].final = True 
-  t[5].final = True
-  return t
-
+  t.set_final(0)
+  t.set_final(5)
+  return t.Build()
+
+
+def constraint_transducers(add_meta_arc=True):
+  """All OT constraint transducers, in the order they are composed."""
+  return [
+      nocoda_transducer(add_meta_arc=add_meta_arc),
+      no_complex_transducer(add_meta_arc=add_meta_arc),
+      no_complex_margin_transducer(add_meta_arc=add_meta_arc),
+      no_complex_vow_transducer(add_meta_arc=add_meta_arc),
+      onset_transducer(add_meta_arc=add_meta_arc),
+      peak_transducer(add_meta_arc=add_meta_arc),
+      ssp_transducer(add_meta_arc=add_meta_arc),
+      length_transducer(add_meta_arc=add_meta_arc),
+  ]
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import itertools
+import collections
 import math
 import fst, operator
 import alphabet
@@ -14,6 +15,14 @@ syms = fst.SymbolTable()
 
 semiring = 'tropical'
 
+def StaticSymbolTable(symbols):
+  """Returns a symbol table with the ids assigned in sorted symbol order, so
+     that they are identical across runs and machines."""
+  table = fst.SymbolTable()
+  for sym in sorted(set(symbols) - set([abc.EPSILON])):
+    table[sym]
+  return table
+
 def Transducer(isyms=None, osyms=None, semiring=semiring):
   global syms
   if isyms is None:
@@ -134,6 +143,233 @@ def Minimize(t):
   assert t.osyms == syms
   return t
 
+class Rule(object):
+  """Collects the arcs of a rewrite rule before it is built as a transducer.
+
+  Arcs added with edit=True start one application of the rule. Build() can
+  bound the number of applications on a path by laying the states out over
+  max_edits + 1 counter layers: edit arcs lead to the next layer and there
+  is none after the last one. It can also emit an edit marker after every
+  edit arc, so that a whole cascade of rules can share a single budget (see
+  operations.edit_budget_transducer).
+
+  Violations are marked with an extra state left by a single epsilon input
+  arc (weighted, or with the rule name as output in meta mode). Build()
+  attaches them to the real arcs leading into that state where it can and
+  removes the remaining epsilons, so the built transducer has fewer states
+  and composes without epsilon filtering."""
+  def __init__(self):
+    self.arcs = []
+    self.finals = {}
+    self.num_states = 1
+
+  def add_arc(self, src, dst, ilabel, olabel, weight=None, edit=False):
+    self.arcs.append((src, dst, ilabel, olabel, weight, edit))
+    self.num_states = max(self.num_states, src + 1, dst + 1)
+
+  def set_final(self, state, weight=True):
+    self.finals[state] = weight
+    self.num_states = max(self.num_states, state + 1)
+
+  def FoldViolations(self):
+    """Folds every violation arc into the arcs that lead to its source
+       state, when that state has no other arc and is not final."""
+    while True:
+      outgoing = collections.defaultdict(list)
+      incoming = collections.defaultdict(list)
+      for arc in self.arcs:
+        outgoing[arc[0]].append(arc)
+        incoming[arc[1]].append(arc)
+      foldable = None
+      for state, out_arcs in outgoing.items():
+        if state == 0 or state in self.finals or len(out_arcs) != 1:
+          continue
+        violation = out_arcs[0]
+        in_arcs = incoming[state]
+        if violation[2] != abc.EPSILON or not in_arcs:
+          continue
+        if any(arc[0] == state for arc in in_arcs):
+          continue
+        if violation[3] != abc.EPSILON and any(arc[3] != abc.EPSILON for arc in in_arcs):
+          # Only one output symbol fits on an arc.
+          continue
+        foldable = (violation, in_arcs)
+        break
+      if foldable is None:
+        return
+      violation, in_arcs = foldable
+      v_src, v_dst, _, v_olabel, v_weight, v_edit = violation
+      folded = []
+      for src, dst, ilabel, olabel, weight, edit in in_arcs:
+        if olabel == abc.EPSILON:
+          olabel = v_olabel
+        folded.append((src, v_dst, ilabel, olabel, AddWeights(weight, v_weight), edit or v_edit))
+      removed = set(id(arc) for arc in in_arcs)
+      removed.add(id(violation))
+      self.arcs = [arc for arc in self.arcs if id(arc) not in removed] + folded
+
+  def Build(self, max_edits=None, edit_marker=False):
+    self.FoldViolations()
+    num_layers = 1 if max_edits is None else max_edits + 1
+    num_edit_arcs = sum(1 for arc in self.arcs if arc[5]) if edit_marker else 0
+    layer_size = self.num_states + num_edit_arcs
+    t = Transducer()
+    for layer in range(num_layers):
+      offset = layer * layer_size
+      marker_state = offset + self.num_states
+      for src, dst, ilabel, olabel, weight, edit in self.arcs:
+        src += offset
+        dst += offset
+        if edit and max_edits is not None:
+          if layer == max_edits:
+            # The budget is spent.
+            continue
+          dst += layer_size
+        if edit and edit_marker:
+          t.add_arc(src, marker_state, ilabel, olabel, weight)
+          t.add_arc(marker_state, dst, abc.EPSILON, abc.EDIT_MARKER)
+          marker_state += 1
+        else:
+          t.add_arc(src, dst, ilabel, olabel, weight)
+      for state, weight in self.finals.items():
+        t[state + offset].final = weight
+    t.remove_epsilon()
+    t.connect()
+    return t
+
+def AddWeights(weight1, weight2):
+  """Tropical product of two optional arc weights."""
+  if weight1 is None:
+    return weight2
+  if weight2 is None:
+    return weight1
+  return float(weight1) + float(weight2)
+
+def AddEditMarkerArcs(transducer):
+  """Returns a copy of transducer that passes the edit markers of earlier
+     operations through. A marker may arrive after any input symbol, so it
+     must be readable at every state reached by one. Reading it also after
+     epsilon input arcs would give duplicate paths, one per state of an
+     epsilon input chain, so every state is split in two: state 2 * s is
+     entered by input arcs (and is the start state) and reads markers,
+     state 2 * s + 1 is entered by epsilon input arcs and does not."""
+  result = Transducer(isyms=transducer.isyms, osyms=transducer.osyms)
+  if len(transducer) == 0:
+    return result
+  result[2 * len(transducer) - 1]
+  result.start = 2 * transducer.start
+  for state_num in range(len(transducer)):
+    state = transducer[state_num]
+    result.add_arc(2 * state_num, 2 * state_num, abc.EDIT_MARKER, abc.EDIT_MARKER)
+    for split in (2 * state_num, 2 * state_num + 1):
+      result[split].final = state.final
+      for arc in state.arcs:
+        isymbol = transducer.isyms.find(arc.ilabel)
+        osymbol = transducer.osyms.find(arc.olabel)
+        nextstate = 2 * arc.nextstate + (1 if arc.ilabel == fst.EPSILON_ID else 0)
+        result.add_arc(split, nextstate, isymbol, osymbol, arc.weight)
+  result.connect()
+  return result
+
+def MapArcs(t, arc_mapper, isyms=None, osyms=None):
+  """Copies t, replacing the (isymbol, osymbol, weight) of every arc by the
+     result of arc_mapper. Arcs for which arc_mapper returns None are dropped."""
+  if len(t) == 0:
+    return t.copy()
+  result = Transducer(isyms=isyms, osyms=osyms)
+  result[len(t) - 1]
+  result.start = t.start
+  for state_num in range(len(t)):
+    state = t[state_num]
+    result[state_num].final = state.final
+    for arc in state.arcs:
+      mapped = arc_mapper(t.isyms.find(arc.ilabel), t.osyms.find(arc.olabel), arc.weight)
+      if mapped is None:
+        continue
+      isymbol, osymbol, weight = mapped
+      result.add_arc(state_num, arc.nextstate, isymbol, osymbol, weight)
+  return result
+
+def InputSymbols(t):
+  """Returns the set of input symbols that appear on the arcs of t."""
+  result = set()
+  for state_num in range(len(t)):
+    for arc in t[state_num].arcs:
+      result.add(t.isyms.find(arc.ilabel))
+  return result
+
+def SpecializeOutputLetters(t, letters):
+  """Drops the arcs of t that output a letter not in letters and keeps only
+     the states on successful paths. Non-letter symbols are always kept. The
+     arcs are filtered by composing t with a one state identity transducer
+     of the kept output symbols, so t is not copied in Python."""
+  keep = Transducer(isyms=t.osyms, osyms=t.osyms)
+  keep[0].final = True
+  for symbol, _ in t.osyms.items():
+    if symbol == abc.EPSILON:
+      continue
+    if symbol not in abc.ALL_LETTERS or symbol in letters:
+      keep.add_arc(0, 0, symbol, symbol)
+  keep.arc_sort_input()
+  specialized = t >> keep
+  specialized.connect()
+  return specialized
+
+def EncodeLabels(t):
+  """Returns an acceptor whose labels encode the isymbol:osymbol pairs of t,
+     and the table that DecodeLabels needs to undo the encoding."""
+  encoding_syms = fst.SymbolTable()
+  pairs = {abc.EPSILON: (abc.EPSILON, abc.EPSILON)}
+  def EncodeArc(isymbol, osymbol, weight):
+    if isymbol == abc.EPSILON and osymbol == abc.EPSILON:
+      return abc.EPSILON, abc.EPSILON, weight
+    label = "{}\t{}".format(isymbol, osymbol)
+    pairs[label] = (isymbol, osymbol)
+    return label, label, weight
+  encoded = MapArcs(t, EncodeArc, isyms=encoding_syms, osyms=encoding_syms)
+  return encoded, pairs
+
+def DecodeLabels(encoded, pairs):
+  def DecodeArc(label, unused_label, weight):
+    isymbol, osymbol = pairs[label]
+    return isymbol, osymbol, weight
+  return MapArcs(encoded, DecodeArc)
+
+def BestPathCost(t):
+  """Returns the cost of the best path of t, or None if t has no path."""
+  if len(t) == 0:
+    return None
+  distances = t.shortest_distance(True)
+  if t.start >= len(distances):
+    return None
+  cost = float(distances[t.start])
+  if math.isinf(cost):
+    return None
+  return cost
+
+def UnweightedAcceptor(t, project_output=False):
+  """Returns the minimized unweighted acceptor of the input (or output)
+     strings of t."""
+  t = t.remove_weights()
+  if project_output:
+    t.project_output()
+  else:
+    t.project_input()
+  return Minimize(t)
+
+def MinimizeEncoded(t):
+  """Like Minimize, but also works for transducers that are not functional
+     (e.g. with meta arcs): t is determinized and minimized as an acceptor
+     over encoded label pairs."""
+  t.remove_epsilon()
+  encoded, pairs = EncodeLabels(t)
+  encoded = encoded.determinize()
+  encoded.minimize()
+  t = DecodeLabels(encoded, pairs)
+  assert t.isyms == syms
+  assert t.osyms == syms
+  return t
+
 def linear_chain(in_str, out_str=None, total_weight=None):
   """Creates a transducer that accepts only input string 'in_str' and outputs 'out_str'."""
   if out_str is None:
@@ -168,11 +404,16 @@ def weights_transducer():
   t.arc_sort_input()
   return t
 
-def Compose(transducers, add_meta_arc=True):
+def Compose(transducers, add_meta_arc=True, has_pass_through=()):
+  """Composes the transducers left to right. Pass through arcs are added to
+     all of them, except to the ones in has_pass_through (e.g. cached products
+     that were already built from transducers with pass through arcs)."""
   if add_meta_arc:
     print("  adding pass through")
+    has_pass_through = set(id(t) for t in has_pass_through)
     for t in transducers:
-      AddPassThroughArcs(t)
+      if id(t) not in has_pass_through:
+        AddPassThroughArcs(t)
       t.arc_sort_input()
 
   print("  combining")
@@ -185,6 +426,16 @@ def Compose(transducers, add_meta_arc=True):
   print()
   return combined
 
+def ComposeRightToLeft(transducers, t):
+  """Composes t with transducers from the last one to the first one. Useful
+     when t is small: every intermediate result is bounded by it."""
+  for left in reversed(transducers):
+    t.arc_sort_input()
+    left.arc_sort_output()
+    t = left >> t
+  t.arc_sort_input()
+  return t
+
 def UnionLinearChains(in_word_list, out_str=None):
   t = Transducer()
   for w in in_word_list:
@@ -21,7 +21,7 @@ NUM_WORKERS=$((${NUM_WORKERS}>${MAX_WORKERS}?${MAX_WORKERS}:${NUM_WORKERS}))
 echo "Using ${NUM_WORKERS} workers"
 
 # Pre-initialize
-nice ./loanwords.py "$@" --worker_id=-1 || { echo "Loanwords initialization failed" ; exit 1 ; }
+nice ./loanwords.py "$@" --worker_id=-1 --init_jobs=${NUM_CPUS} || { echo "Loanwords initialization failed" ; exit 1 ; }
 
 let LAST_WORKER=NUM_WORKERS-1
 for WORKER_ID in $(seq 0 ${LAST_WORKER}) ; do
@@ -3,6 +3,9 @@
 
 import phone_transducer as pt
 
+# Used as the final weight of unsyllabification.
+RULE_NAMES = ["<<BIAS>>"]
+
 def syllabification_transducer(add_meta_arc=True):
   """Appends CONSONANT_DOTs and VOWEL_DOTs symbols."""
   t = pt.Transducer()
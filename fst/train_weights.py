@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+# Discriminative training of the constraint weights on the candidates that
+# loanwords.py --candidates_dir writes: structured perceptron, MIRA or a
+# pairwise ranking loss. The updates use the difference of the violation
+# vectors of the best correct candidate and of the best competing one, so
+# a few rounds of decoding with --candidates_dir and training replace the
+# black-box search of nm.py.
+
+"""
+./loanwords.py --test_file ../data/train.en-mt-it --in_ot_constraint_weights ../data/constraints/uniform.txt \
+               --candidates_dir candidates/round1 ...
+./train_weights.py --candidates_dirs candidates/round1 --init_weights ../data/constraints/uniform.txt \
+                   --algorithm mira --out_weights weights/mira_round1
+"""
+import argparse
+import line_search
+import numpy as np
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--candidates_dirs", nargs="+", required=True)
+parser.add_argument("--init_weights", required=True)
+parser.add_argument("--out_weights", required=True)
+parser.add_argument("--default_weight", default=0.0, type=float)
+parser.add_argument("--algorithm", default="perceptron", choices=["perceptron", "mira", "ranking"])
+parser.add_argument("--num_epochs", default=10, type=int)
+parser.add_argument("--learning_rate", default=1.0, type=float)
+parser.add_argument("--margin", default=1.0, type=float,
+                    help="Cost margin of the correct candidate for MIRA and ranking.")
+parser.add_argument("--mira_c", default=100.0, type=float, help="Largest MIRA step.")
+parser.add_argument("--no_average", default=False, action="store_true",
+                    help="Use the last weights instead of the average over all updates.")
+parser.add_argument("--seed", default=0, type=int)
+args = None  # Set in main.
+
+def Oracle(sample, w):
+  """Returns the violation vectors of the best correct and of the best
+     incorrect candidate, or None if the sample has no such pair."""
+  correct = sample.num_correct > 0
+  incorrect = sample.counts > sample.num_correct
+  if not correct.any() or not incorrect.any():
+    return None
+  costs = sample.violations.dot(w)
+  best_correct = np.nonzero(correct)[0][np.argmin(costs[correct])]
+  best_incorrect = np.nonzero(incorrect)[0][np.argmin(costs[incorrect])]
+  return sample.violations[best_correct], sample.violations[best_incorrect]
+
+def Updates(sample, w):
+  """Yields the updates of w for one sample. Costs are minimized, so the
+     updates raise the cost of the competitor above the cost of the correct
+     candidate. The caller applies every update to w in place before the
+     next one is made, so each ranking pair is checked against the current
+     weights."""
+  if args.algorithm == "ranking":
+    correct = sample.violations[sample.num_correct > 0]
+    incorrect = sample.violations[sample.counts > sample.num_correct]
+    for v_correct in correct:
+      for v_incorrect in incorrect:
+        diff = v_incorrect - v_correct
+        if diff.any() and w.dot(diff) < args.margin:
+          yield args.learning_rate * diff
+    return
+  oracle = Oracle(sample, w)
+  if oracle is None:
+    return
+  v_correct, v_incorrect = oracle
+  diff = v_incorrect - v_correct
+  if not diff.any():
+    # A violation vector of both correct and incorrect candidates: no update
+    # separates them.
+    return
+  loss = args.margin - w.dot(diff)
+  if args.algorithm == "perceptron":
+    if w.dot(diff) <= 0:
+      yield args.learning_rate * diff
+  elif loss > 0:
+    yield min(args.mira_c, loss / diff.dot(diff)) * diff
+
+def Train(samples, w, num_reachable_correct):
+  """Returns the weights of the epoch with the best accuracy, and the
+     accuracy. The weights are kept non-negative."""
+  random_state = np.random.RandomState(args.seed)
+  w = np.array(w, dtype=float)
+  w_sum = np.zeros(len(w))
+  num_steps = 0
+  best_accuracy = line_search.Accuracy(samples, w, num_reachable_correct)
+  best_w = w.copy()
+  print("Initial accuracy:", best_accuracy)
+  for epoch in range(args.num_epochs):
+    num_updates = 0
+    for i in random_state.permutation(len(samples)):
+      for update in Updates(samples[i], w):
+        np.maximum(w + update, 0.0, out=w)
+        num_updates += 1
+      w_sum += w
+      num_steps += 1
+    epoch_w = w.copy() if args.no_average else w_sum / num_steps
+    accuracy = line_search.Accuracy(samples, epoch_w, num_reachable_correct)
+    print("Epoch {}: {} updates, accuracy: {}".format(epoch, num_updates, accuracy))
+    if accuracy > best_accuracy:
+      best_accuracy, best_w = accuracy, epoch_w.copy()
+    if num_updates == 0:
+      break
+  return best_w, best_accuracy
+
+def main():
+  global args
+  args = parser.parse_args()
+  init_weights = line_search.LoadWeightsFromFile(args.init_weights)
+  samples, num_reachable_correct, constraint_list = line_search.LoadCandidates(
+      args.candidates_dirs, list(init_weights))
+  print("Loaded {} samples, {} reachable correct, {} constraints".format(
+      len(samples), num_reachable_correct, len(constraint_list)))
+  w = [init_weights.get(c, args.default_weight) for c in constraint_list]
+  w, accuracy = Train(samples, w, num_reachable_correct)
+  print("Final accuracy on the candidates:", accuracy)
+  with open(args.out_weights, "w") as f:
+    for c, weight in zip(constraint_list, w):
+      f.write("{}\t{}\n".format(c, weight))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Partitioning of the donor (AR) vocabulary into groups with a coarse
+profile, and safe bounds that skip the groups that cannot yield a SW word.
+
+The profile of a pronunciation is its length and its number of hard
+consonants. Hard consonants are the consonants that no operation can turn
+into a vowel or delete, so they can only disappear with a stripped AR affix
+or by merging with other phones in a substitution."""
+
+import phone_transducer as pt
+import morphology
+import collections
+import hashlib
+import math
+import os
+
+# Width of the length ranges of the groups.
+LENGTH_RANGE = 4
+
+def Letters(s):
+  """Letters of one side of a substitution, as the operations read them."""
+  return tuple(s)
+
+def HardConsonants():
+  hard = pt.abc.CONSONANTS - pt.abc.VOWELS
+  for s_ar, s_sw in pt.abc.AR_SW_SIMILAR_PHONES:
+    if not any(l in pt.abc.CONSONANTS - pt.abc.VOWELS for l in Letters(s_sw)):
+      hard = hard - set(Letters(s_ar))
+  return hard
+
+def Profile(pron, hard=None):
+  """Returns (length, number of hard consonants) of a pronunciation."""
+  if hard is None:
+    hard = HardConsonants()
+  return len(pron), sum(1 for l in pron if l in hard)
+
+class GroupStats(object):
+  """Ranges of the profiles of the pronunciations in a group."""
+  def __init__(self, min_len, max_len, min_hard, max_hard):
+    self.min_len = min_len
+    self.max_len = max_len
+    self.min_hard = min_hard
+    self.max_hard = max_hard
+
+  @staticmethod
+  def FromWords(words, hard=None):
+    profiles = [Profile(w, hard) for w in words]
+    return GroupStats(min(p[0] for p in profiles), max(p[0] for p in profiles),
+                      min(p[1] for p in profiles), max(p[1] for p in profiles))
+
+  def ToDict(self):
+    return dict(self.__dict__)
+
+  @staticmethod
+  def FromDict(d):
+    return GroupStats(d["min_len"], d["max_len"], d["min_hard"], d["max_hard"])
+
+class VocabGroup(object):
+  """A group of the vocab. Groups without stats are never skipped, groups
+     without an (unweighted) acceptor are never pre-checked."""
+  def __init__(self, transducer, stats=None, acceptor=None):
+    self.transducer = transducer
+    self.stats = stats
+    self.acceptor = acceptor
+
+class StoredVocabGroup(object):
+  """A group of the vocab that is read from disk by a VocabGroupProvider
+     when its transducer or acceptor is used."""
+  def __init__(self, provider, filename, acceptor_filename, stats=None):
+    self.provider = provider
+    self.filename = filename
+    self.acceptor_filename = acceptor_filename
+    self.stats = stats
+
+  @property
+  def transducer(self):
+    return self.provider.Get(self.filename)
+
+  @property
+  def acceptor(self):
+    return self.provider.Get(self.acceptor_filename)
+
+class VocabGroupProvider(object):
+  """Streams the vocab groups from disk. The groups are scanned in the same
+  order for every word, so recency says nothing about reuse (an LRU smaller
+  than all the groups evicts every group before it is read again). Instead,
+  the groups that are read first are kept in memory up to max_bytes, and the
+  others are read again on every use. Their size is estimated by the size of
+  their files, as the transducers are read in whole (there is no mmap in
+  pyfst)."""
+  def __init__(self, groups, load, max_bytes):
+    """groups are (filename, acceptor filename, stats), load(filename)
+       reads a transducer."""
+    self.groups = [StoredVocabGroup(self, filename, acceptor_filename, stats)
+                   for filename, acceptor_filename, stats in groups]
+    self.load = load
+    self.max_bytes = max_bytes
+    self.cache = {}
+    self.cached_bytes = 0
+    self.num_gets = 0
+    self.num_loads = 0
+
+  def __len__(self):
+    return len(self.groups)
+
+  def __getitem__(self, i):
+    return self.groups[i]
+
+  def __iter__(self):
+    return iter(self.groups)
+
+  def Get(self, filename):
+    self.num_gets += 1
+    if filename in self.cache:
+      return self.cache[filename]
+    t = self.load(filename)
+    self.num_loads += 1
+    size = os.path.getsize(filename)
+    if self.cached_bytes + size <= self.max_bytes:
+      self.cache[filename] = t
+      self.cached_bytes += size
+    return t
+
+  def CacheStats(self):
+    """Returns a description of the hit rate and of the resident groups."""
+    hits = self.num_gets - self.num_loads
+    return "{} of {} reads from memory ({:.1%}), {} files resident in {:.1f} MB".format(
+        hits, self.num_gets, hits / max(1, self.num_gets), len(self.cache),
+        self.cached_bytes / 2**20)
+
+def PronBucket(ipa_pron, num_buckets):
+  """Returns the bucket of a pronunciation, from the MD5 of its phones, so it
+     does not depend on the rest of the dictionary or on the hash seed."""
+  m = hashlib.md5()
+  m.update(" ".join(ipa_pron).encode("utf-8"))
+  return int(m.hexdigest(), 16) % num_buckets
+
+def PartitionVocab(pron_dict, limit=None, group_size=5000):
+  """Returns (name, words) pairs that split the words in pron_dict by length
+     range and number of hard consonants, and then into MD5 buckets of about
+     group_size. A word's group depends only on the word and on the number
+     of buckets of its profile (a power of two), so a dictionary update
+     changes only the groups of the added and removed words."""
+  print("Loading the vocab file")
+  vocab = set()
+  for word, ipa_pron_set in pron_dict.items():
+    for ipa_pron in ipa_pron_set:
+      vocab.add(ipa_pron)  # ipa_pron is tuple('d', 'o̯', 'e̯')
+    if limit is not None and len(vocab) > limit:
+      break
+
+  print("Checking missing letters in Alphabet")
+  seen_letters = set()
+  for w in vocab:
+    seen_letters.update(set(w))
+  missing_letters = seen_letters - pt.abc.ALL_LETTERS
+  assert len(missing_letters) == 0, missing_letters
+
+  hard = HardConsonants()
+  profiles = collections.defaultdict(list)
+  for w in sorted(vocab):
+    length, num_hard = Profile(w, hard)
+    profiles[(length // LENGTH_RANGE, num_hard)].append(w)
+  groups = []
+  for (length_range, num_hard), words in sorted(profiles.items()):
+    num_buckets = 1
+    while num_buckets * group_size < len(words):
+      num_buckets *= 2
+    buckets = collections.defaultdict(list)
+    for w in words:
+      buckets[PronBucket(w, num_buckets)].append(w)
+    for bucket, bucket_words in sorted(buckets.items()):
+      name = "L{}_H{}_{}".format(length_range, num_hard, bucket)
+      groups.append((name, bucket_words))
+  print("Vocab size:", len(vocab), "num groups:", len(groups))
+  return groups
+
+class DonorBounds(object):
+  """Bounds on the profile of the AR pronunciations that can yield any of
+  the SW pronunciations. They follow from the operations:
+
+  - AR morphology strips at most one prefix and one suffix, SW morphology
+    appends at most one prefix and one suffix.
+  - Vowel deletion and epenthesis delete and insert only vowels, at most
+    max_edits times each if it is given.
+  - Substitutions map len(s_ar) letters to len(s_sw) letters, and hard
+    consonants only to outputs with a hard consonant.
+  - Final vowel substitution maps one vowel to another.
+  """
+  def __init__(self, sw_pron_list, max_edits=None):
+    self.hard = HardConsonants()
+    non_vowels = pt.abc.CONSONANTS - pt.abc.VOWELS
+    pairs = [(Letters(s_ar), Letters(s_sw)) for s_ar, s_sw in pt.abc.AR_SW_SIMILAR_PHONES]
+    # Max number of letters one AR letter expands to, and max number of AR
+    # letters that merge into one letter.
+    self.expansion = max([1] + [len(s_sw) / len(s_ar) for s_ar, s_sw in pairs])
+    self.contraction = max([1] + [len(s_ar) / len(s_sw) for s_ar, s_sw in pairs])
+    # Max number of AR hard consonants a SW letter can come from.
+    self.hard_sources = collections.defaultdict(int)
+    for l in self.hard:
+      self.hard_sources[l] = 1
+    # SW letters that can come without any AR hard consonant.
+    self.free = set(pt.abc.VOWELS)
+    for s_ar, s_sw in pairs:
+      num_hard = sum(1 for l in s_ar if l in self.hard)
+      for l in s_sw:
+        self.hard_sources[l] = max(self.hard_sources[l], num_hard)
+      if num_hard == 0:
+        self.free.update(s_sw)
+    # Max number of hard consonants in the SW output of one AR hard consonant.
+    self.hard_expansion = max([1] + [
+        sum(1 for l in s_sw if l in non_vowels) / sum(1 for l in s_ar if l in self.hard)
+        for s_ar, s_sw in pairs if any(l in self.hard for l in s_ar)])
+
+    ar_prefixes = [Letters(a) for a in morphology.morphemes.AR_PREFIXES] + [()]
+    ar_suffixes = [Letters(a) for a in morphology.morphemes.AR_SUFFIXES] + [()]
+    self.ar_affix_len = max(map(len, ar_prefixes)) + max(map(len, ar_suffixes))
+    self.ar_affix_hard = (max(Profile(a, self.hard)[1] for a in ar_prefixes) +
+                          max(Profile(a, self.hard)[1] for a in ar_suffixes))
+
+    self.min_len = float("inf")
+    self.max_len = 0
+    self.min_hard = float("inf")
+    self.max_hard = 0
+    self.num_cores = 0
+    for sw_pron in sw_pron_list:
+      for core in self.Cores(tuple(sw_pron)):
+        self.AddCore(core, max_edits)
+
+  def Cores(self, sw_pron):
+    """SW pronunciations without the SW affixes that they may end with."""
+    sw_prefixes = [Letters(a) for a in morphology.morphemes.SW_PREFIXES] + [()]
+    sw_suffixes = [Letters(a) for a in morphology.morphemes.SW_SUFFIXES] + [()]
+    for prefix in sw_prefixes:
+      if sw_pron[:len(prefix)] != prefix:
+        continue
+      for suffix in sw_suffixes:
+        if len(prefix) + len(suffix) > len(sw_pron):
+          continue
+        if sw_pron[len(sw_pron) - len(suffix):] != suffix:
+          continue
+        yield sw_pron[len(prefix):len(sw_pron) - len(suffix)]
+
+  def AddCore(self, core, max_edits):
+    num_vowels = sum(1 for l in core if l in pt.abc.VOWELS)
+    epenthesis = num_vowels if max_edits is None else min(num_vowels, max_edits)
+    self.min_len = min(self.min_len, math.ceil((len(core) - epenthesis) / self.expansion))
+    if max_edits is None:
+      # Vowel deletion is unbounded.
+      self.max_len = float("inf")
+    else:
+      self.max_len = max(self.max_len, math.floor(len(core) * self.contraction) +
+                                       max_edits + self.ar_affix_len)
+    num_hard = sum(1 for l in core if l in self.hard and l not in self.free)
+    self.min_hard = min(self.min_hard, math.ceil(num_hard / self.hard_expansion))
+    self.max_hard = max(self.max_hard, sum(self.hard_sources[l] for l in core) + self.ar_affix_hard)
+    self.num_cores += 1
+
+  def Skip(self, stats):
+    """Returns True if no pronunciation in a group with stats is within the
+       bounds."""
+    if stats is None or self.num_cores == 0:
+      return False
+    return (stats.max_hard < self.min_hard or stats.min_hard > self.max_hard or
+            stats.max_len < self.min_len or stats.min_len > self.max_len)